@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Timing helpers to compare alternative code paths on real structures.
+
+Run them from Chimera's IDLE shell, e.g.::
+
+    from propkagui import benchmarks
+    benchmarks.structure_input(chimera.openModels.list()[0])
+"""
+
+from __future__ import print_function, division
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+import chimera
+import propka.lib
+import propka.molecular_container
+from libtangram.core import enter_directory, ignored
+from core import Controller
+from engine import propka_run
+from container import PropkaContainer, atoms_from_records
+import regression
+from regression import best_of as _best_of
+
+
+def structure_input(molecule, options=('-q',), repeat=3):
+    """
+    Time how long it takes to get `molecule` into a PropKa molecular container
+    with each of the available input paths:
+
+    - `file`: `Controller.write_pdb` + `Molecular_container(path, args)`
+    - `stream`: `Controller.pdb_contents` + `PropkaContainer(StringIO, args)`
+    - `records`: `Controller.atom_records` + `PropkaContainer(records, args)`
+
+    Returns
+    -------
+    dict
+        Best wall time in seconds of each path.
+    """
+    args, _ = propka.lib.loadOptions(*options)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'molecule.pdb')
+
+        def from_file():
+            Controller.write_pdb(molecule, path)
+            with enter_directory(tmpdir):
+                propka.molecular_container.Molecular_container(path, args)
+
+        def from_stream():
+            PropkaContainer(StringIO(Controller.pdb_contents(molecule)), args)
+
+        def from_records():
+            PropkaContainer(Controller.atom_records(molecule), args)
+
+        timings = {'file': _best_of(from_file, repeat),
+                   'stream': _best_of(from_stream, repeat),
+                   'records': _best_of(from_records, repeat)}
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print('{} ({} atoms)'.format(molecule.name, len(molecule.atoms)))
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1]):
+        print('  {:<8} {:8.3f} s'.format(name, seconds))
+    return timings
+
+
+def _written_bytes():
+    """
+    Bytes written by this process so far (Linux only, None elsewhere).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def file_io(molecule, options=('-q',)):
+    """
+    Compare the bytes written to disk by the legacy temporary PDB path
+    (`write_pdb` + `Molecular_container`, which also writes the
+    ``.propka_input`` file) against `engine.propka_run` in no-files mode.
+    """
+    args, _ = propka.lib.loadOptions(*options)
+    counts = {}
+    before = _written_bytes()
+    with Controller.temporary_pdb(molecule) as path:
+        with enter_directory(os.path.dirname(path)):
+            propka.molecular_container.Molecular_container(path, args)
+        counts['legacy'] = _written_bytes() - before if before is not None else None
+        with ignored(OSError):
+            os.remove(os.path.splitext(path)[0] + '.propka_input')
+    before = _written_bytes()
+    propka_run(Controller.atom_records(molecule), list(options))
+    counts['no-files'] = _written_bytes() - before if before is not None else None
+    print('{}: bytes written per job {}'.format(molecule.name, counts))
+    return counts
+
+
+def charge_profile(molecule, options=('-q',), grids=((0., 14., .1), (0., 14., .01)),
+                   repeat=3):
+    """
+    `regression.charge_profile` on an open model.
+    """
+    return regression.charge_profile(Controller.atom_records(molecule), options=options,
+                                     grids=grids, repeat=repeat, name=molecule.name)
+
+
+def isoelectric_point(molecule, options=('-q',), grid=(0., 14., 1), repeat=3):
+    """
+    `regression.isoelectric_point` on an open model.
+    """
+    return regression.isoelectric_point(Controller.atom_records(molecule), options=options,
+                                        grid=grid, repeat=repeat, name=molecule.name)
+
+
+def folding_profile(molecule, options=('-q',), grids=((0., 14., .1), (0., 14., .01)),
+                    references=('neutral', 'low-pH'), repeat=3):
+    """
+    `regression.folding_profile` on an open model.
+    """
+    return regression.folding_profile(Controller.atom_records(molecule), options=options,
+                                      grids=grids, references=references, repeat=repeat,
+                                      name=molecule.name)
+
+
+def residue_lookup(molecule, repeat=3):
+    """
+    Time setting a residue attribute on every residue of `molecule` (e.g. a
+    50k-residue assembly), from values keyed like PropKa results, by parsing
+    one specifier per residue and evaluating it against all open models, as
+    the old `PropKaResultsDialog.set_attr` did, and through
+    `Controller.residue_index` (index construction included).
+
+    Returns
+    -------
+    dict
+        Best wall time in seconds of each path.
+    """
+    index = Controller.residue_index(molecule)
+    values = dict(((r.type, number, chain), 0.0)
+                  for ((chain, number), residues) in index.items() for r in residues[:1])
+
+    def by_specifier():
+        for (_, number, chain) in values:
+            # PropKa's '_' is Chimera's blank chain, as in Controller.residue_index
+            chain = '' if chain == '_' else chain
+            selection = chimera.specifier.evalSpec(':{}.{}'.format(number, chain))
+            for residue in selection.residues():
+                residue.propkaBenchmark = 0.0
+
+    def by_index():
+        residues_by_id = Controller.residue_index(molecule)
+        for (_, number, chain) in values:
+            for residue in residues_by_id.get((chain, number), ()):
+                residue.propkaBenchmark = 0.0
+
+    timings = {'specifier': _best_of(by_specifier, repeat),
+               'index': _best_of(by_index, repeat)}
+    print('{} ({} residues)'.format(molecule.name, len(molecule.residues)))
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1]):
+        print('  {:<10} {:8.3f} s'.format(name, seconds))
+    return timings
+
+
+def _termini(records):
+    return set((atom.terminal, atom.resNumb, atom.chainID)
+               for (_, atom) in atoms_from_records(records) if atom.terminal)
+
+
+def buffered_termini(molecule, chains, buffer=3.0):
+    """
+    Regression check for chain exports with a spatial buffer: residues kept
+    from neighbouring chains must not introduce N+ or C- groups that the
+    complete structure does not have.
+
+    Returns
+    -------
+    set
+        (terminal, residue number, chain) of the spurious termini; empty if
+        the check passes.
+    """
+    full = _termini(Controller.atom_records(molecule))
+    buffered = _termini(Controller.atom_records(molecule, chains=chains, buffer=buffer))
+    spurious = buffered - full
+    print('{} chains {} + {} A: {}'.format(molecule.name, ','.join(chains), buffer,
+                                           'ok' if not spurious else
+                                           'spurious termini {}'.format(sorted(spurious))))
+    return spurious
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Persistent, content-addressed cache for PropKa results.
+
+Entries are keyed by a hash of the structure contents plus the normalized
+PropKa options and the plugin/PropKa versions, so any change in either
+produces a cache miss. Files are evicted in least-recently-used order
+(by modification time, which is refreshed on every hit) once the total
+size of the cache directory exceeds a given budget. The total is measured
+once and then kept up to date on writes, so the directory is only walked
+again when eviction is actually needed.
+"""
+
+from __future__ import print_function, division
+import hashlib
+import os
+import sys
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def user_cache_dir(appname='tangram_propkagui'):
+    """
+    Platform-dependent directory for user cache files.
+    """
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        return os.path.join(base, appname, 'Cache')
+    if sys.platform == 'darwin':
+        return os.path.join(os.path.expanduser('~/Library/Caches'), appname)
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, appname)
+
+
+def normalize_options(options):
+    """
+    Turn a list of PropKa CLI arguments into a canonical tuple of strings,
+    so that equivalent values (``7``, ``'7.0'``, ``7.0``) hash the same.
+    Verbosity flags are dropped since they do not affect the results.
+    """
+    normalized = []
+    for option in options:
+        if option in ('-q', '--quiet', '-z', '--verbose'):
+            continue
+        try:
+            option = '{:g}'.format(float(option))
+        except (TypeError, ValueError):
+            option = str(option)
+        normalized.append(option)
+    return tuple(normalized)
+
+
+class ResultCache(object):
+
+    """
+    On-disk cache of `propka_run` results.
+
+    Parameters
+    ----------
+    path : str, optional
+        Cache directory. Defaults to `user_cache_dir()`.
+    max_size : int, optional
+        Maximum size in bytes of the whole cache directory.
+    version : str, optional
+        Version tag mixed into every key (plugin and PropKa versions),
+        so upgrades never serve stale results.
+    """
+
+    suffix = '.pickle'
+    #: Fraction of `max_size` the cache is trimmed to once it overflows, so
+    #: eviction (a walk of the whole directory) does not run on every write
+    low_water = 0.9
+
+    def __init__(self, path=None, max_size=256 * 1024 * 1024, version=''):
+        if path is None:
+            path = user_cache_dir()
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self._size = None  # running estimate of the directory size
+
+    def key(self, pdb, options):
+        """
+        Hash of the PDB contents plus the normalized options.
+        """
+        sha = hashlib.sha1()
+        sha.update(self.version.encode('utf-8'))
+        sha.update(b'\0'.join(o.encode('utf-8') for o in normalize_options(options)))
+        sha.update(b'\0')
+        sha.update(pdb if isinstance(pdb, bytes) else pdb.encode('utf-8'))
+        return sha.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key + self.suffix)
+
+    def get(self, key, default=None):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                results = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+        try:
+            os.utime(filename, None)  # mark as recently used
+        except OSError:
+            pass
+        return results
+
+    def set(self, key, results):
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # Write to a temporary file first so readers never see partial entries
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(results, f, protocol=2)
+            written = os.path.getsize(tmp)
+            replaced = 0
+            if os.path.exists(filename):
+                replaced = os.path.getsize(filename)
+                os.remove(filename)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            return False
+        if self._size is None:
+            self._size = sum(size for (_, size, _) in self.entries())
+        else:
+            self._size += written - replaced
+        if self._size > self.max_size:
+            self.evict(int(self.max_size * self.low_water))
+        return True
+
+    def __contains__(self, key):
+        return os.path.isfile(self._filename(key))
+
+    def entries(self):
+        """
+        List of (mtime, size, path) for every entry, oldest first.
+        """
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self, max_size=None):
+        """
+        Remove least recently used entries until the cache fits in `max_size`.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        total = sum(size for (_, size, _) in entries)
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+    def clear(self):
+        self.evict(max_size=0)
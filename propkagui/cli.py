@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Headless batch runner: PropKa over many PDB files, no Chimera needed.
+
+Each structure produces one JSON line, written as soon as it is done::
+
+    tangram_propka structures/*.pdb -j 8 -o results.jsonl --propka "-o 7.4"
+
+When writing to a file, finished inputs are journaled to a manifest next to
+it (``results.jsonl.manifest``); running the same command again after a
+crash skips them and appends the remaining results.
+"""
+
+from __future__ import print_function, division
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shlex
+import sys
+import traceback
+from .engine import propka_run, run_many
+from .manifest import Manifest, file_digest, trim_partial_line
+from .columnar import save_batch, jsonl_records
+
+
+def expand_inputs(patterns, list_file=None):
+    """
+    Paths from `patterns` (expanded as globs if they contain wildcards)
+    and from `list_file` (one path or glob per line), without duplicates.
+    """
+    patterns = list(patterns)
+    if list_file is not None:
+        with open(list_file) as f:
+            patterns.extend(line.strip() for line in f if line.strip())
+    paths, seen = [], set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+def jsonable(results):
+    """
+    Turn a `propka_run` results dict into JSON-friendly types: residue
+    keyed dicts become lists of records and groups become objects.
+    Titration curves are left out; they can be recomputed from the groups.
+    """
+    residues = [{'residue_type': residue_type, 'number': number, 'chain': chain,
+                 'pka': pka, 'charge': results['residues_charge'].get((residue_type, number, chain))}
+                for ((residue_type, number, chain), pka) in sorted(results['residues_pka'].items())]
+    data = dict((k, v.tolist() if hasattr(v, 'tolist') else v) for (k, v) in results.items()
+                if k not in ('residues_pka', 'residues_charge', 'groups', 'titration'))
+    data['residues'] = residues
+    data['groups'] = [group._asdict() for group in results.get('groups', ())]
+    return data
+
+
+def _safe_job(task):
+    """
+    Like `engine._pool_job`, but failures are reported instead of raised,
+    so one broken structure does not abort the whole batch.
+    """
+    i, (name, path), options = task
+    try:
+        return i, {'input': path, 'results': jsonable(propka_run(path, options, name=name))}
+    except Exception as e:
+        return i, {'input': path, 'error': '{}: {}'.format(type(e).__name__, e),
+                   'traceback': traceback.format_exc()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='tangram_propka',
+        description='Run PropKa on a batch of PDB files and write one JSON line per structure.')
+    parser.add_argument('inputs', nargs='*', metavar='PDB',
+                        help='PDB files or glob patterns (quote them to avoid shell expansion)')
+    parser.add_argument('-l', '--list', dest='list_file', metavar='FILE',
+                        help='file with one PDB path or glob pattern per line')
+    parser.add_argument('-o', '--output', default='-', metavar='FILE',
+                        help='JSON lines output file (default: stdout)')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--propka', default='', metavar='ARGS',
+                        help='extra PropKa options, as a single quoted string (e.g. "-o 7.4")')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='journal of finished inputs used to resume interrupted runs '
+                             '(default: OUTPUT.manifest when writing to a file)')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='do not skip inputs already in the manifest; start a new output')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='when resuming, run again the inputs that failed before')
+    parser.add_argument('--columns', metavar='DIR',
+                        help='also convert the output to a memory-mappable columnar store '
+                             '(see propkagui.columnar); requires --output')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = expand_inputs(args.inputs, args.list_file)
+    if not paths:
+        print('No input files given', file=sys.stderr)
+        return 2
+    if args.columns and args.output == '-':
+        print('--columns requires --output', file=sys.stderr)
+        return 2
+    options = ['-q'] + shlex.split(args.propka)
+
+    manifest_path = args.manifest
+    if manifest_path is None and args.output != '-':
+        manifest_path = args.output + '.manifest'
+    if manifest_path is not None and not args.resume and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    manifest = Manifest(manifest_path) if manifest_path is not None else None
+
+    digests = {}
+    for path in paths:
+        try:
+            digests[path] = file_digest(path)
+        except (IOError, OSError):  # reported as an error by the job itself
+            digests[path] = None
+    if manifest is not None:
+        pending = [p for p in paths if not manifest.is_done(p, digests[p], options) and
+                   (args.retry_failed or not manifest.is_failed(p, digests[p], options))]
+        if len(pending) < len(paths):
+            print('Resuming: skipping {} finished inputs'.format(len(paths) - len(pending)),
+                  file=sys.stderr)
+        paths = pending
+    jobs = [(os.path.basename(path), path) for path in paths]
+
+    if args.output == '-':
+        # PropKa prints its own messages to stdout; send them to stderr at the
+        # descriptor level (so workers inherit it) and keep stdout for JSON
+        sys.stdout.flush()
+        output = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    elif manifest is not None and args.resume:
+        # A crash may have left a half-written last record: drop it, since
+        # its input is not in the manifest and will be run again
+        trim_partial_line(args.output)
+        output = open(args.output, 'a')
+    else:
+        output = open(args.output, 'w')
+    failed = 0
+    try:
+        for done, (_, record) in enumerate(run_many(jobs, options, processes=args.processes,
+                                                    function=_safe_job), 1):
+            failed += 'error' in record
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+            output.flush()
+            if manifest is not None:
+                # Journal only once the result itself is safely on disk
+                try:
+                    os.fsync(output.fileno())
+                except OSError:  # pipes and terminals cannot be synced
+                    pass
+                path = record['input']
+                manifest.record(path, digests[path], options,
+                                status='error' if 'error' in record else 'done')
+            print('[{}/{}] {}: {}'.format(done, len(jobs), record['input'],
+                                          'failed' if 'error' in record else 'done'),
+                  file=sys.stderr)
+    finally:
+        output.close()
+    if args.columns:
+        save_batch(args.columns, jsonl_records(args.output))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Columnar, memory-mappable storage for PropKa results.
+
+Results are saved to a directory of NumPy ``.npy`` files, one per column,
+plus a ``residues.npy`` index table and a ``meta.json`` file with scalar
+values, written last so incomplete stores are never picked up. Stores are
+opened with `numpy.load(..., mmap_mode='r')`, so even multi-GB outputs open
+instantly and only the slices actually used (a residue, a frame, a
+structure) are read from disk.
+
+Three layouts exist, depending on what was saved (``meta['kind']``):
+
+- ``single``: one structure. ``pka.npy`` and ``charge.npy`` are vectors
+  aligned with ``residues.npy``.
+- ``trajectory``: ``frames.npy`` plus frame x residue ``pka.npy`` and
+  ``charge.npy`` matrices, as built by `trajectory.combine_frames`. Results
+  aggregated with `trajectory.FrameStatistics` store their per-residue
+  statistics (``pka_mean.npy``, ``pka_histogram.npy``...) instead.
+- ``batch``: many different structures, in long format: one row per
+  structure and residue in ``structure.npy``, ``residue.npy`` (index into
+  ``residues.npy``), ``pka.npy`` and ``charge.npy``. Rows of structure `i`
+  span ``offsets[i]:offsets[i + 1]``.
+
+Per-residue means (``pka_mean.npy``, ``charge_mean.npy``), titratable groups,
+pH profiles and titration curves (``titration_residues.npy``,
+``titration_ph.npy`` and the group x pH ``titration_charge.npy``) are stored
+as well for single and trajectory stores, so the results dialog can show
+them without touching the large matrices.
+"""
+
+from __future__ import print_function, division
+import array
+import json
+import os
+import numpy as np
+from .profiles import TitratableGroup
+from .results import PropkaResults
+
+
+RESIDUE_DTYPE = np.dtype([('residue_type', 'S6'), ('number', '<i4'), ('chain', 'S4')])
+GROUP_DTYPE = np.dtype([('residue_type', 'S6'), ('number', '<i4'), ('chain', 'S4'),
+                        ('pka', '<f8'), ('model_pka', '<f8'), ('charge', '<f8'),
+                        ('ddg_neutral', '<f8')])
+SCALARS = ('pi_folded', 'pi_unfolded', 'pH_opt', 'dG_opt', 'dG_min', 'dG_max',
+           'pH_min', 'pH_max')
+STATISTICS = ('count', 'mean', 'std', 'min', 'max', 'histogram', 'bins')
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def residue_table(residues):
+    """
+    Structured array of (residue_type, number, chain) keys.
+    """
+    return np.array([(t.encode('utf-8'), n, c.encode('utf-8')) for (t, n, c) in residues],
+                    dtype=RESIDUE_DTYPE)
+
+
+def _column(values, dtype):
+    """
+    NumPy view of an `array.array` column, without copying it.
+    """
+    if not len(values):
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype=dtype)
+
+
+def _save(path, name, values, dtype=None):
+    np.save(os.path.join(path, name + '.npy'), np.asarray(values, dtype=dtype))
+
+
+def _write_meta(path, meta):
+    tmp = os.path.join(path, '.meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, sort_keys=True)
+    target = os.path.join(path, 'meta.json')
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(tmp, target)
+
+
+def _prepare(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    meta = os.path.join(path, 'meta.json')
+    if os.path.exists(meta):  # invalidate before overwriting any column
+        os.remove(meta)
+
+
+def save_results(path, results, dtype='float32'):
+    """
+    Save a `propka_run` results dict, plain or merged from trajectory frames,
+    to the directory `path`. Large matrices are stored as `dtype`.
+    """
+    _prepare(path)
+    meta = dict((key, None if results.get(key) is None else float(results[key]))
+                for key in SCALARS)
+    trajectory, statistics = results.get('trajectory'), results.get('statistics')
+    if trajectory is not None:
+        meta['kind'] = 'trajectory'
+        residues = trajectory['residues']
+        _save(path, 'frames', trajectory['frames'])
+        _save(path, 'pka', trajectory['pka'], dtype)
+        _save(path, 'charge', trajectory['charge'], dtype)
+    elif statistics is not None:
+        meta['kind'] = 'trajectory'
+        meta['frames'] = statistics['frames']
+        residues = statistics['residues']
+        for prefix in ('pka', 'charge'):
+            for field in STATISTICS:
+                _save(path, '{}_{}'.format(prefix, field), statistics[prefix][field])
+    else:
+        meta['kind'] = 'single'
+        residues = sorted(results['residues_pka'])
+    _save(path, 'residues', residue_table(residues))
+    _save(path, 'pka_mean', [results['residues_pka'].get(r, np.nan) for r in residues])
+    _save(path, 'charge_mean', [results['residues_charge'].get(r, np.nan) for r in residues])
+    if 'residues_pka_std' in results:
+        _save(path, 'pka_std', [results['residues_pka_std'].get(r, np.nan) for r in residues])
+    if meta['kind'] == 'single':
+        _save(path, 'pka', [results['residues_pka'][r] for r in residues], dtype)
+        _save(path, 'charge', [results['residues_charge'][r] for r in residues], dtype)
+    groups = [(g.residue_type.encode('utf-8'), g.number, g.chain.encode('utf-8'), g.pka,
+               g.model_pka, g.charge, g.ddg_neutral) for g in results.get('groups', ())]
+    _save(path, 'groups', np.array(groups, dtype=GROUP_DTYPE))
+    _save(path, 'charge_profile', results['charge_profile'])
+    _save(path, 'folding_profile', results['folding_profile'])
+    titration = results.get('titration')
+    if titration is not None:
+        _save(path, 'titration_residues', residue_table(titration['residues']))
+        _save(path, 'titration_ph', titration['ph'])
+        _save(path, 'titration_charge', titration['charge'], dtype)
+    meta['format'] = 'propkagui-columns'
+    meta['version'] = 1
+    _write_meta(path, meta)
+
+
+def save_batch(path, records, dtype='float32'):
+    """
+    Save many structures to the directory `path`, in long format.
+
+    Parameters
+    ----------
+    records : iterable
+        ``(name, residues)`` pairs, where `residues` is an iterable of
+        ``(residue_type, number, chain, pka, charge)``, or ``(name, None)``
+        for structures that failed. They are consumed one at a time, so a
+        generator keeps memory use down to the compact columns themselves.
+    """
+    _prepare(path)
+    index, residues = {}, []
+    structure, residue = array.array('i'), array.array('i')
+    pka, charge = array.array('d'), array.array('d')
+    offsets, names, errors = [0], [], []
+    for name, rows in records:
+        if rows is None:
+            errors.append(name)
+            continue
+        i = len(names)
+        names.append(name)
+        for residue_type, number, chain, value, q in rows:
+            key = residue_type, number, chain
+            j = index.get(key)
+            if j is None:
+                j = index[key] = len(residues)
+                residues.append(key)
+            structure.append(i)
+            residue.append(j)
+            pka.append(value if value is not None else np.nan)
+            charge.append(q if q is not None else np.nan)
+        offsets.append(len(structure))
+    _save(path, 'residues', residue_table(residues))
+    _save(path, 'structure', _column(structure, np.intc), '<i4')
+    _save(path, 'residue', _column(residue, np.intc), '<i4')
+    _save(path, 'pka', _column(pka, float), dtype)
+    _save(path, 'charge', _column(charge, float), dtype)
+    _save(path, 'offsets', offsets, '<i8')
+    _write_meta(path, {'format': 'propkagui-columns', 'version': 1, 'kind': 'batch',
+                       'structures': names, 'errors': errors})
+
+
+def jsonl_records(filename):
+    """
+    Read the JSON lines written by the `cli` and `dirqueue` runners as
+    records for `save_batch`. If an input appears more than once (e.g. a
+    failed input retried after resuming), only its last entry is kept.
+    """
+    last = {}
+    with open(filename) as f:
+        for number, line in enumerate(f):
+            try:
+                last[json.loads(line)['input']] = number
+            except (ValueError, KeyError, TypeError):  # line corrupted by a crash
+                continue
+    keep = set(last.values())
+    with open(filename) as f:
+        for number, line in enumerate(f):
+            if number not in keep:
+                continue
+            record = json.loads(line)
+            if 'error' in record:
+                yield record['input'], None
+                continue
+            yield record['input'], ((r['residue_type'], r['number'], r['chain'], r['pka'],
+                                     r['charge']) for r in record['results']['residues'])
+
+
+class ColumnarResults(object):
+
+    """
+    Read-only, memory-mapped view of a store written by `save_results` or
+    `save_batch`. Columns are only mapped when first used.
+
+    Parameters
+    ----------
+    path : str
+        Store directory.
+    mmap_mode : str or None, optional
+        As in `numpy.load`. Use None to load columns fully into memory.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.kind = self.meta['kind']
+        self._arrays = {}
+        self._index = None
+
+    def __contains__(self, name):
+        return os.path.exists(os.path.join(self.path, name + '.npy'))
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'),
+                                         mmap_mode=self.mmap_mode)
+        return self._arrays[name]
+
+    @property
+    def residues(self):
+        """
+        Residue keys as (residue_type, number, chain) tuples, in column order.
+        """
+        return [(_text(t), int(n), _text(c)) for (t, n, c) in self['residues'].tolist()]
+
+    def index(self, residue):
+        """
+        Column of `residue`, a (residue_type, number, chain) key.
+        """
+        if self._index is None:
+            self._index = dict((key, j) for (j, key) in enumerate(self.residues))
+        return self._index[residue]
+
+    @property
+    def frames(self):
+        return self['frames'] if 'frames' in self else None
+
+    def residue(self, residue, field='pka'):
+        """
+        Values of one residue: its time series for trajectories, or one value
+        per structure containing it (plus their indices) for batches.
+        """
+        j = self.index(residue)
+        if self.kind == 'trajectory':
+            return self[field][:, j]
+        if self.kind == 'batch':
+            rows = np.flatnonzero(self['residue'] == j)
+            return self['structure'][rows], self[field][rows]
+        return self[field][j]
+
+    def frame(self, i, field='pka'):
+        """
+        Values of all residues in the `i`-th stored frame.
+        """
+        return self[field][i]
+
+    def structure(self, i, field='pka'):
+        """
+        (residue keys, values) of the `i`-th structure of a batch.
+        """
+        start, stop = self['offsets'][i], self['offsets'][i + 1]
+        residues = self['residues'][self['residue'][start:stop]]
+        keys = [(_text(t), int(n), _text(c)) for (t, n, c) in residues.tolist()]
+        return keys, self[field][start:stop]
+
+    def results(self):
+        """
+        Results dict in the layout the results dialog expects. Large
+        matrices stay memory-mapped in the ``trajectory`` entry.
+        """
+        if self.kind == 'batch':
+            raise ValueError('Batch stores hold many structures; use structure() instead')
+        residues = self.residues
+        results = dict((key, self.meta.get(key)) for key in SCALARS)
+        results['residues_pka'] = dict(zip(residues, self['pka_mean'].tolist()))
+        results['residues_charge'] = dict(zip(residues, self['charge_mean'].tolist()))
+        if 'pka_std' in self:
+            results['residues_pka_std'] = dict(zip(residues, self['pka_std'].tolist()))
+        results['groups'] = [TitratableGroup(_text(t), n, _text(c), pka, model_pka, q, ddg)
+                             for (t, n, c, pka, model_pka, q, ddg) in self['groups'].tolist()]
+        results['charge_profile'] = self['charge_profile'].tolist()
+        results['folding_profile'] = self['folding_profile'].tolist()
+        if 'titration_charge' in self:
+            results['titration'] = {
+                'residues': [(_text(t), int(n), _text(c))
+                             for (t, n, c) in self['titration_residues'].tolist()],
+                'ph': self['titration_ph'], 'charge': self['titration_charge']}
+        if self.kind == 'trajectory' and 'frames' in self:
+            results['trajectory'] = {'frames': self['frames'], 'residues': residues,
+                                     'pka': self['pka'], 'charge': self['charge']}
+        elif self.kind == 'trajectory':
+            statistics = {'frames': self.meta.get('frames'), 'residues': residues}
+            for prefix in ('pka', 'charge'):
+                statistics[prefix] = dict((field, self['{}_{}'.format(prefix, field)])
+                                          for field in STATISTICS)
+            results['statistics'] = statistics
+        return PropkaResults.from_dict(results)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+PropKa molecular container that does not depend on files.
+
+PropKa's `Molecular_container` takes a path, derives output names from it
+and writes a ``.propka_input`` file to the current directory as a side
+effect. `PropkaContainer` performs the same setup from an in-memory PDB
+stream instead, without touching the filesystem, or directly from a list
+of `AtomRecord`, skipping PDB formatting and parsing altogether. Any file
+PropKa derives from the molecule name is rooted at an explicit working
+directory, never at the process-wide current directory.
+"""
+
+from __future__ import print_function, division
+import os
+from collections import namedtuple
+import numpy as np
+# propka.molecular_container must come first: importing propka.atom
+# on its own triggers a circular import inside PropKa
+import propka.molecular_container
+import propka.atom
+import propka.conformation_container
+import propka.lib
+import propka.output
+import propka.parameters
+import propka.pdb
+import propka.version
+
+
+AtomRecord = namedtuple('AtomRecord', 'record serial name residue_name chain residue_number '
+                                       'insertion_code altloc x y z occupancy bfactor element '
+                                       'terminal')
+# `terminal` is None when termini must be inferred from the record order,
+# otherwise 'N+', 'C-' or '' (not terminal), as set by `mark_termini`
+AtomRecord.__new__.__defaults__ = (None,)
+
+
+def _terminal_flags(records, ignore_residues=()):
+    """
+    Terminal group ('N+', 'C-' or None) of each record, with the logic of
+    `propka.pdb.get_atom_lines_from_pdb`: a change of chain or a TER record
+    starts a new chain, whose first ATOM residue gets the N-terminus, and
+    OXT atoms mark C-termini.
+    """
+    nterm_residue = 'next_residue'
+    old_residue = None
+    previous_chain = None
+    for r in records:
+        terminal = None
+        if r.record == 'TER':
+            nterm_residue = 'next_residue'
+            yield terminal
+            continue
+        if r.chain != previous_chain:
+            nterm_residue = 'next_residue'
+            previous_chain = r.chain
+        if r.residue_name[:3] in ignore_residues:
+            yield terminal
+            continue
+
+        residue_id = r.residue_number, r.insertion_code
+        if nterm_residue == 'next_residue' and r.record == 'ATOM':
+            if old_residue != residue_id:
+                nterm_residue = residue_id
+                old_residue = None
+
+        if r.record == 'ATOM':
+            if r.name == 'N' and nterm_residue == residue_id:
+                terminal = 'N+'
+            if r.name in ('OXT', "O''"):
+                terminal = 'C-'
+                nterm_residue = 'next_residue'
+                old_residue = residue_id
+        yield terminal
+
+
+def mark_termini(records, ignore_residues=()):
+    """
+    Copy of `records` with their `terminal` field set from the complete
+    structure, so that subsets (see `restrict_to_chains`) keep the real
+    termini instead of inferring new ones at every gap.
+    """
+    return [r._replace(terminal=terminal or '')
+            for (r, terminal) in zip(records, _terminal_flags(records, ignore_residues))]
+
+
+def atoms_from_records(records, ignore_residues=(), keep_protons=False, chains=None):
+    """
+    Build PropKa atoms from `AtomRecord` objects, reproducing the logic of
+    `propka.pdb.get_atom_lines_from_pdb` (conformation labels, terminal
+    detection, residue and hydrogen filtering) without going through PDB text.
+
+    Records must be sorted like in a PDB file. A change of chain is handled
+    like a TER record; explicit chain breaks can be marked with records
+    whose `record` field is ``'TER'`` (all other fields are ignored).
+    Records whose `terminal` field is set (see `mark_termini`) keep it
+    instead.
+
+    Yields
+    ------
+    conformation_name, propka.atom.Atom
+    """
+    for r, terminal in zip(records, _terminal_flags(records, ignore_residues)):
+        if r.record == 'TER' or r.residue_name[:3] in ignore_residues:
+            continue
+        if chains and r.chain not in chains:
+            continue
+        if r.terminal is not None:
+            terminal = r.terminal or None
+
+        altloc = r.altloc.strip() or 'A'
+        if altloc in '123456789':
+            altloc = chr(ord(altloc) + 16)
+
+        if r.element == 'H' and not keep_protons:
+            continue
+
+        atom = propka.atom.Atom()
+        atom.name = r.name
+        atom.numb = r.serial
+        atom.x, atom.y, atom.z = r.x, r.y, r.z
+        atom.resNumb = r.residue_number
+        atom.resName = '%-3s' % r.residue_name[:3]
+        atom.chainID = r.chain if r.chain.strip() else '_'
+        atom.type = r.record.lower()
+        if atom.resName in ('DA ', 'DC ', 'DG ', 'DT '):
+            atom.type = 'hetatm'
+        atom.occ = '{:.2f}'.format(r.occupancy)
+        atom.beta = '{:.2f}'.format(r.bfactor)
+        atom.icode = r.insertion_code or ' '
+        atom.element = r.element
+        atom.residue_label = '%-3s%4d%2s' % (atom.name, atom.resNumb, atom.chainID)
+        atom.terminal = terminal
+        yield '1' + altloc, atom
+
+
+def with_coordinates(records, xyz):
+    """
+    Copy of `records` with the coordinates of the (n, 3) array `xyz`.
+    """
+    return [r._replace(x=x, y=y, z=z) for (r, (x, y, z)) in zip(records, xyz.tolist())]
+
+
+def restrict_to_chains(records, chains, buffer=0.0):
+    """
+    Keep only the records of the requested `chains`, plus every residue of
+    other chains (including ligands and waters) that has at least one atom
+    within `buffer` angstroms of them, so PropKa still sees the environment
+    that can influence the requested chains. Termini are marked on the full
+    structure first (see `mark_termini`), so the first residue kept from a
+    neighbouring chain does not become a charged N-terminus. Explicit TER
+    records are then dropped.
+    """
+    chains = set(chains)
+    records = [r for r in mark_termini(records) if r.record != 'TER']
+    selected = np.array([r.chain in chains for r in records], dtype=bool)
+    if buffer <= 0 or selected.all() or not selected.any():
+        return [r for (r, keep) in zip(records, selected) if keep]
+
+    xyz = np.array([(r.x, r.y, r.z) for r in records], dtype=float)
+    core = xyz[selected]
+    # Cheap prefilter: only atoms inside the buffered bounding box can be close
+    lower, upper = core.min(axis=0) - buffer, core.max(axis=0) + buffer
+    candidates = np.flatnonzero(~selected & (xyz >= lower).all(axis=1) & (xyz <= upper).all(axis=1))
+
+    # Hash selected atoms in cells of `buffer` side, check the 27 neighbouring cells
+    cells = {}
+    for index, cell in enumerate(map(tuple, np.floor(core / buffer).astype(int))):
+        cells.setdefault(cell, []).append(index)
+    cutoff2 = buffer * buffer
+    close_residues = set()
+    for index in candidates:
+        r = records[index]
+        residue = r.chain, r.residue_number, r.insertion_code
+        if residue in close_residues:
+            continue
+        cx, cy, cz = np.floor(xyz[index] / buffer).astype(int)
+        neighbours = [i for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                      for i in cells.get((cx + dx, cy + dy, cz + dz), ())]
+        if neighbours and (((core[neighbours] - xyz[index]) ** 2).sum(axis=1) <= cutoff2).any():
+            close_residues.add(residue)
+
+    return [r for (r, keep) in zip(records, selected)
+            if keep or (r.chain, r.residue_number, r.insertion_code) in close_residues]
+
+
+class PropkaContainer(propka.molecular_container.Molecular_container):
+
+    """
+    Parameters
+    ----------
+    source : file-like or list of AtomRecord
+        PDB contents, as accepted by `propka.lib.open_file_for_reading`,
+        or atom records as built by `core.Controller.atom_records`.
+    options : optparse.Values
+        As returned by `propka.lib.loadOptions`.
+    name : str, optional
+        Name of the molecule, only used to label output files.
+    workdir : str, optional
+        Directory where files derived from the molecule name are placed
+        (e.g. ligand mol2 files or `write_output_files` products). Since
+        PropKa builds those paths from `self.name`, rooting it here keeps
+        concurrent jobs isolated without changing the current directory.
+    parameters : propka.parameters.Parameters, optional
+        Already loaded parameters, to avoid parsing `options.parameters` again.
+    """
+
+    def __init__(self, source, options, name='molecule.pdb', workdir='', parameters=None):
+        propka.output.printHeader()
+
+        self.options = options
+        self.input_file = name
+        self.dir, self.file = workdir, os.path.basename(name)
+        self.name = os.path.join(workdir, os.path.splitext(self.file)[0])
+
+        if parameters is None:
+            parameters = propka.parameters.Parameters(options.parameters)
+        try:
+            self.version = getattr(propka.version, parameters.version)(parameters)
+        except AttributeError:
+            raise ValueError('Version {} does not exist'.format(parameters.version))
+
+        if hasattr(source, 'read'):
+            self.conformations, self.conformation_names = \
+                propka.pdb.read_pdb(source, self.version.parameters, self)
+        else:
+            self.conformations, self.conformation_names = self.read_records(source)
+        if not self.conformations:
+            raise ValueError('The input does not contain any molecular conformations')
+
+        # Same setup as the PDB branch of Molecular_container.__init__
+        self.top_up_conformations()
+        propka.pdb.protein_precheck(self.conformations, self.conformation_names)
+        self.version.setup_bonding_and_protonation(self)
+        self.extract_groups()
+        for name in self.conformation_names:
+            self.conformations[name].sort_atoms()
+        self.find_covalently_coupled_groups()
+
+    def read_records(self, records):
+        """
+        Counterpart of `propka.pdb.read_pdb` for `AtomRecord` sequences.
+
+        Unlike PDB input, records are not filtered by the ``-c`` option: chain
+        subsetting is done beforehand with `restrict_to_chains`, which may keep
+        neighbouring residues of other chains on purpose.
+        """
+        parameters = self.version.parameters
+        atoms = atoms_from_records(records, ignore_residues=parameters.ignore_residues,
+                                   keep_protons=self.options.keep_protons)
+        conformations = {}
+        for name, atom in atoms:
+            if name not in conformations:
+                conformations[name] = propka.conformation_container.Conformation_container(
+                    name=name, parameters=parameters, molecular_container=self)
+            conformations[name].add_atom(atom)
+        names = sorted(conformations, key=propka.lib.conformation_sorter)
+        return conformations, names
+
+    def write_output_files(self, reference='neutral'):
+        """
+        Write the ``.propka_input`` and ``.pka`` files the PropKa CLI would
+        create, inside the working directory.
+
+        Returns
+        -------
+        list of str
+            Paths of the written files.
+        """
+        input_file = self.name + '.propka_input'
+        pka_file = self.name + '.pka'
+        propka.pdb.write_input(self, input_file)
+        propka.output.writePKA(self, self.version.parameters, filename=pka_file,
+                               conformation='AVR', reference=reference, options=self.options)
+        return [input_file, pka_file]
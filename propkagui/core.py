@@ -5,60 +5,346 @@
 from __future__ import print_function, division
 # Python stdlib
 import contextlib
+import multiprocessing
 import os
+from collections import OrderedDict, deque
+from StringIO import StringIO
+import threading
+import time
+import traceback
+import Queue
+import tkFileDialog
+from Tkinter import TclError
 # Chimera stuff
 import chimera
+from chimera import replyobj
 from OpenSave import osTemporaryFile
 # Additional 3rd parties
+import numpy as np
 try:
     import propka
-    import propka.lib
-    import propka.molecular_container
 except ImportError as e :
     raise chimera.UserError("PropKa is not installed!" + str(e))
 # Own
-from libtangram.core import ignored, enter_directory
+from libtangram.core import ignored
+from cache import ResultCache
+from store import ResultStore
+from profiles import batch_ph_profiles
+from container import AtomRecord, restrict_to_chains, with_coordinates
+from engine import (propka_run, run_many, parse_chains, split_profile_options,
+                    cache_version)
+from reuse import EnvironmentCache
+from trajectory import select_frames, combine_frames, FrameStatistics
+from columnar import ColumnarResults
 import gui
 
 
 class Controller(object):
 
-    results = {}
+    # Shared so results survive reopening the dialog. Bounded and weak-keyed,
+    # and emptied for each molecule as soon as it is closed.
+    results = ResultStore()
+    _remove_handler = None
 
     def __init__(self, gui, model, *args, **kwargs):
         self.gui = gui
         self.model = model
+        self.worker = None
+        self.feed = None
+        self.results_dialog = None
+        self._refresh_profiles_id = None
+        if Controller._remove_handler is None:
+            Controller._remove_handler = chimera.openModels.addRemoveHandler(
+                Controller._on_models_removed, None)
+
+    @classmethod
+    def _on_models_removed(cls, trigger_name, data, models):
+        for model in models:
+            cls.results.discard(model)
 
     def run(self):
+        if self.worker is not None and self.worker.is_alive():
+            replyobj.status('A PropKa job is already running!', color='red')
+            return
+        molecules = tuple(m for m in self.molecules if m is not None)
+        if not molecules:
+            replyobj.status('Select the molecules to run PropKa on', color='red')
+            return
         cli_args = self.optional_arguments
-        for molecule in self.molecules:
-            self.results[molecule] = results = self.run_single(molecule, cli_args)
-        results_dialog = gui.PropKaResultsDialog(master=self.gui.uiMaster(),
-                                                 molecules=self.molecules)
-        results_dialog.fillInData(results)
-        results_dialog.enter()
-
-    def run_single(self, molecule, options):
-        pdb = self.write_pdb(molecule)
-        with enter_directory(os.path.dirname(pdb)):
-            results = propka_run(pdb, options)
+        # Chimera objects are only touched here, in the main thread
+        chains = parse_chains(self.model.chains)
+        buffer = self.model.chains_buffer
+        frames = self.model.frames if self.model.trajectory else None
+        specs, owners = [], []
+        for molecule in molecules:
+            for frame, coordset in self.coordsets(molecule, frames):
+                name = molecule.name if frame is None else '{} #{}'.format(molecule.name, frame)
+                specs.append((molecule, name, coordset))
+                owners.append((molecule, frame))
+        # Structures are exported incrementally, so long trajectories do not block Tk
+        jobs = self.feed = JobFeed(self.gui.uiMaster(), specs, chains=chains, buffer=buffer)
+        cache = ResultCache(version=cache_version()) if self.model.use_cache else None
+        reuse_tolerance = self.model.reuse_tolerance if frames is not None else None
+        profile_options = split_profile_options(cli_args)[1]
+        profile_options['adaptive'] = self.model.ph_adaptive
+        collect, statistics = None, None
+        if frames is not None and self.model.streaming:
+            # Aggregate frames as they complete instead of keeping them all
+            statistics = OrderedDict((molecule, FrameStatistics()) for molecule in molecules)
+            def collect(i, result):
+                statistics[owners[i][0]].add(result)
+        self.worker = Worker(self._run_jobs, args=(jobs, cli_args, self.model.processes, cache,
+                                                   reuse_tolerance, collect),
+                             master=self.gui.uiMaster(),
+                             callback=lambda results: self._on_finished(owners, results,
+                                                                        profile_options,
+                                                                        statistics),
+                             errback=self._on_error,
+                             progress=self._on_progress)
+        self.gui.buttonWidgets['Run'].configure(state='disabled')
+        self.worker.start()
+        jobs.start()
+
+    def stop(self):
+        if self.worker is not None and self.worker.is_alive():
+            self.worker.cancel()
+            self._release_feed()
+            replyobj.status('Cancelling PropKa job...')
+
+    def run_single(self, molecule, options, progress=None):
+        return propka_run(self.atom_records(molecule), options, progress=progress,
+                          name=molecule.name)
+
+    @staticmethod
+    def _run_jobs(jobs, options, processes=1, cache=None, reuse_tolerance=None, collect=None,
+                  progress=None):
+        """
+        Run `propka_run` for each (name, atom records) pair, given as a list
+        or a `JobFeed`. Executed in the worker thread.
+
+        Jobs found in `cache` are not computed again. Single jobs run in-thread
+        so per-stage progress can be reported. Batches are fanned out across a
+        pool of `processes` processes (one PropKa per core by default) and
+        progress is reported per completed molecule. If `reuse_tolerance` is
+        given, desolvation terms of similar group environments are reused
+        between jobs (see `reuse.EnvironmentCache`).
+
+        If `collect` is given, it is called with ``(index, result)`` as each
+        job completes and results are not kept, so the returned list only
+        holds None. Jobs are consumed lazily and their atom records dropped
+        once computed, which bounds memory use for very large batches.
+        """
+        total = len(jobs)
+        results = [None] * total
+        keys = {}
+        names = {}
+        pending = []  # job index of each job handed to PropKa, in order
+        hits = deque()  # cached results, finished from this thread
+
+        def finish(i, result, computed=True):
+            if computed and cache is not None:
+                cache.set(keys.pop(i), result)
+            if collect is not None:
+                collect(i, result)
+            else:
+                results[i] = result
+
+        def flush():
+            # Profiles of all the hits queued so far share one pI solve
+            if not hits:
+                return
+            batch = [hits.popleft() for _ in range(len(hits))]
+            profiles = batch_ph_profiles([cached['groups'] for (_, cached) in batch],
+                                         **profile_options)
+            for (i, cached), profile in zip(batch, profiles):
+                progress('{}: using cached results'.format(names.pop(i)))
+                cached.update(profile)
+                finish(i, cached, computed=False)
+
+        if cache is not None:
+            # pH profiles are re-derived below, so they are not part of the key
+            pka_options, profile_options = split_profile_options(options)
+            if reuse_tolerance:  # approximate results must not mix with exact ones
+                pka_options += ['--reuse-tolerance', str(reuse_tolerance)]
+
+        def uncached():
+            # May run in the pool's task thread: only queue cache hits here
+            for i, (name, pdb) in enumerate(jobs):
+                names[i] = name
+                if cache is not None:
+                    keys[i] = cache.key(repr(pdb), pka_options)
+                    cached = cache.get(keys[i])
+                    if cached is not None and 'groups' in cached:
+                        del keys[i]
+                        hits.append((i, cached))
+                        continue
+                pending.append(i)
+                yield name, pdb
+
+        if total == 1 or processes == 1:
+            reuse = EnvironmentCache(reuse_tolerance) if reuse_tolerance is not None else None
+            for n, (name, pdb) in enumerate(uncached(), 1):
+                flush()
+                def report(message, _prefix='[{}/{}] {}: '.format(n, total, name)):
+                    progress(_prefix + message)
+                i = pending[-1]
+                del names[i]
+                finish(i, propka_run(pdb, options, progress=report, name=name, reuse=reuse))
+                del pdb
+        else:
+            progress('Running up to {} jobs in {} processes'.format(total, processes))
+            batch = run_many(uncached(), options, processes=processes,
+                             reuse_tolerance=reuse_tolerance, count=total)
+            for done, (j, result) in enumerate(batch, 1):
+                flush()
+                i = pending[j]
+                finish(i, result)
+                progress('[{}/{}] {}: done'.format(done, total, names.pop(i)))
+        flush()
         return results
 
+    def _on_finished(self, owners, results, profile_options=None, statistics=None):
+        """
+        Store the `results` of each job, given as (molecule, frame) `owners`.
+        Frames of the same molecule are merged into one trajectory result,
+        or taken from their `statistics` if they were aggregated on the fly.
+        """
+        self._release_feed()
+        self._restore_buttons()
+        profile_options = profile_options or {}
+        grouped = OrderedDict()
+        for (molecule, frame), result in zip(owners, results):
+            grouped.setdefault(molecule, []).append((frame, result))
+        data = OrderedDict()
+        adaptive = []  # single structures whose profiles need the adaptive grid
+        for molecule, frame_results in grouped.items():
+            frames, results = zip(*frame_results)
+            if statistics is not None and molecule in statistics:
+                data[molecule] = statistics[molecule].results(**profile_options)
+            elif frames[0] is None:
+                data[molecule] = results[0]
+                if profile_options.get('adaptive') and 'groups' in results[0]:
+                    adaptive.append(results[0])
+            else:
+                data[molecule] = combine_frames(frames, results, **profile_options)
+        profiles = batch_ph_profiles([results['groups'] for results in adaptive],
+                                     **profile_options)
+        for results, profile in zip(adaptive, profiles):
+            results.update(profile)
+        for molecule, results in data.items():
+            self.results[molecule] = results
+        reuse = [r['reuse'] for r in data.values() if 'reuse' in r]
+        if reuse:
+            rate = sum(r['reused'] for r in reuse) / max(1, sum(r['groups'] for r in reuse))
+            replyobj.status('PropKa job finished ({:.0%} of group environments reused)'.format(rate))
+        else:
+            replyobj.status('PropKa job finished')
+        self._show_results(data)
+
+    def _show_results(self, data):
+        self.results_dialog = gui.PropKaResultsDialog(master=self.gui.uiMaster(),
+                                                      molecules=tuple(data))
+        self.results_dialog.fillInData(data)
+        self.results_dialog.enter()
+
+    def load(self):
+        """
+        Open results saved from the results dialog (a columnar store) and
+        show them for the selected molecule. Large arrays stay on disk.
+        """
+        molecules = self.molecules
+        if not molecules or molecules[0] is None:
+            replyobj.status('Select the molecule the results belong to', color='red')
+            return
+        path = tkFileDialog.askdirectory(parent=self.gui.uiMaster(), mustexist=True,
+                                         title='Open saved PropKa results')
+        if not path:
+            return
+        try:
+            results = ColumnarResults(path).results()
+        except (IOError, OSError, ValueError, KeyError) as e:
+            replyobj.error('Could not open PropKa results in {}: {}\n'.format(path, e))
+            return
+        self.results[molecules[0]] = results
+        self._show_results(OrderedDict([(molecules[0], results)]))
+
+    def refresh_profiles(self):
+        """
+        Re-derive the pH profiles of every stored result with the current pH
+        grid and reference, without running PropKa again, and update the
+        results dialog if it is still open.
+        """
+        self._refresh_profiles_id = None
+        try:
+            grid, reference = self.model.ph_grid, self.model.ph_reference
+            adaptive = self.model.ph_adaptive
+        except (ValueError, TclError):  # user is still typing
+            return
+        if grid[2] <= 0 or grid[0] > grid[1]:
+            return
+        stored = [results for (_, results) in self.results.items() if 'groups' in results]
+        profiles = batch_ph_profiles([results['groups'] for results in stored], grid=grid,
+                                     reference=reference, adaptive=adaptive)
+        for results, profile in zip(stored, profiles):
+            results.update(profile)
+        self.results.update_sizes()
+        if self.results_dialog is not None:
+            with ignored(TclError):
+                self.results_dialog.fillInData(self.results_dialog._data)
+
+    def _schedule_refresh_profiles(self, *args):
+        master = self.gui.uiMaster()
+        if self._refresh_profiles_id is not None:
+            master.after_cancel(self._refresh_profiles_id)
+        self._refresh_profiles_id = master.after(300, self.refresh_profiles)
+
+    def _on_error(self, exc, tb):
+        self._release_feed()
+        self._restore_buttons()
+        if isinstance(exc, JobCancelled):
+            replyobj.status('PropKa job cancelled')
+            return
+        replyobj.status('PropKa job failed!', color='red')
+        replyobj.error('PropKa job failed:\n' + tb)
+
+    def _on_progress(self, message):
+        replyobj.status(message)
+
+    def _release_feed(self):
+        # Stops pending export callbacks and frees the exported frames
+        if self.feed is not None:
+            self.feed.cancel()
+            self.feed = None
+
+    def _restore_buttons(self):
+        with ignored(TclError):
+            self.gui.buttonWidgets['Run'].configure(state='normal')
+
     def set_mvc(self):
         # Tie model and gui
-        names = ['ph', 'ph_window', 'ph_grid', 'ph_reference', 'mutations', 'chains',
-                 'mutations_method', 'mutations_options', 'titrate', 'keep_protons']
+        names = ['ph', 'ph_window', 'ph_grid', 'ph_adaptive', 'ph_reference', 'mutations',
+                 'chains', 'mutations_method', 'mutations_options', 'titrate', 'keep_protons',
+                 'processes', 'use_cache', 'trajectory', 'streaming']
         for name in names:
             with ignored(AttributeError):
                 var = getattr(self.model, '_' + name)
                 var.trace(lambda *args: setattr(self.model, name, var.get()))
 
+        # pH profiles can be recomputed from existing results on the fly
+        for var in self.gui._ph_grid + (self.gui._ph_reference, self.gui._ph_adaptive):
+            var.trace('w', self._schedule_refresh_profiles)
+
         # Buttons callbacks
         self.gui.buttonWidgets['Run'].configure(command=self.run)
+        self.gui.buttonWidgets['Stop'].configure(command=self.stop)
+        self.gui.buttonWidgets['Load'].configure(command=self.load)
 
     @property
     def molecules(self):
-        return self.gui.ui_molecules.getvalue(),
+        molecules = self.gui.ui_molecules.getvalue()
+        if isinstance(molecules, (list, tuple)):
+            return tuple(molecules)
+        return molecules,
 
     @property
     def optional_arguments(self):
@@ -87,9 +373,9 @@ class Controller(object):
             args.append(self.model.titrate)
         if self.model.keep_protons:
             args.append('-k')
-        if self.model.chains:
+        for chain in parse_chains(self.model.chains):
             args.append('-c')
-            args.append(self.model.chains)
+            args.append(chain)
 
         return args
 
@@ -100,6 +386,102 @@ class Controller(object):
         chimera.pdbWrite([molecule], molecule.openState.xform, path)
         return path
 
+    @classmethod
+    @contextlib.contextmanager
+    def temporary_pdb(cls, molecule):
+        """
+        Context manager version of `write_pdb` that removes the file on exit,
+        so batch runs that still need PDB files on disk do not leave them behind.
+        """
+        path = cls.write_pdb(molecule)
+        try:
+            yield path
+        finally:
+            with ignored(OSError):
+                os.remove(path)
+
+    @staticmethod
+    def pdb_contents(molecule):
+        """
+        Same as `write_pdb`, but into an in-memory buffer, whose contents are returned.
+        """
+        stream = StringIO()
+        chimera.pdbWrite([molecule], molecule.openState.xform, stream)
+        return stream.getvalue()
+
+    @staticmethod
+    def coordsets(molecule, frames=None):
+        """
+        (frame, coordset) pairs to run for `molecule`. Without `frames`, only
+        the current coordinates are used and both values are None. Otherwise,
+        `frames` is a (start, stop, stride) tuple applied to the coordinate
+        sets of the molecule (e.g. the frames loaded by MD Movie).
+        """
+        if frames is None or len(molecule.coordSets) < 2:
+            return [(None, None)]
+        keys = select_frames(molecule.coordSets.keys(), *frames)
+        return [(key, molecule.coordSets[key]) for key in keys]
+
+    @staticmethod
+    def residue_index(molecule):
+        """
+        Map the (chain, number) of each residue of `molecule`, as PropKa
+        reports them (blank chains become ``'_'``), to the list of Chimera
+        residues with that id (several if they have insertion codes).
+        """
+        index = {}
+        for residue in molecule.residues:
+            rid = residue.id
+            chain = rid.chainId if rid.chainId.strip() else '_'
+            index.setdefault((chain, rid.position), []).append(residue)
+        return index
+
+    @staticmethod
+    def exported_atoms(molecule):
+        """
+        Atoms of `molecule`, with their residue, in the order `atom_records`
+        exports them.
+        """
+        for residue in molecule.residues:
+            for atom in sorted(residue.atoms, key=lambda a: getattr(a, 'serialNumber', 0)):
+                yield residue, atom
+
+    @staticmethod
+    def coordinates(molecule, coordset):
+        """
+        Scene coordinates of the atoms of `molecule` in `coordset`, as an
+        (n, 3) array in `atom_records` order.
+        """
+        coords = [atom.xformCoord(coordset) for (_, atom) in Controller.exported_atoms(molecule)]
+        return np.array([(c.x, c.y, c.z) for c in coords], dtype=float)
+
+    @staticmethod
+    def atom_records(molecule, chains=None, buffer=0.0, coordset=None):
+        """
+        Export the atoms of `molecule` as a list of `AtomRecord`, in scene
+        coordinates (like `write_pdb` does with `openState.xform`), so PropKa
+        atoms can be built without formatting and parsing PDB text.
+
+        If `chains` is given, only those chains are exported, plus the residues
+        of other chains within `buffer` angstroms of them. If `coordset` is
+        given, its coordinates are used instead of the active ones.
+        """
+        records = []
+        for serial, (residue, atom) in enumerate(Controller.exported_atoms(molecule), 1):
+            rid = residue.id
+            record = 'HETATM' if residue.isHet else 'ATOM'
+            coord = atom.xformCoord() if coordset is None else atom.xformCoord(coordset)
+            records.append(AtomRecord(record, getattr(atom, 'serialNumber', serial),
+                                      atom.name, residue.type, rid.chainId, rid.position,
+                                      rid.insertionCode or ' ', atom.altLoc or ' ',
+                                      coord.x, coord.y, coord.z,
+                                      getattr(atom, 'occupancy', 1.0),
+                                      getattr(atom, 'bfactor', 0.0),
+                                      atom.element.name))
+        if chains:
+            records = restrict_to_chains(records, chains, buffer=buffer)
+        return records
+
 
 class ViewModel(object):
 
@@ -107,6 +489,7 @@ class ViewModel(object):
         'ph': 7.0,
         'ph_window': [0, 14, 1],
         'ph_grid': [0, 14, 1],
+        'ph_adaptive': False,
         'ph_reference': 'neutral',
         'mutations': '',
         'mutations_method': 'alignment',
@@ -114,6 +497,13 @@ class ViewModel(object):
         'titrate': '',
         'keep_protons': True,
         'chains': '',
+        'chains_buffer': 0.0,
+        'processes': multiprocessing.cpu_count(),
+        'use_cache': True,
+        'trajectory': False,
+        'frames': [1, 0, 1],
+        'reuse_tolerance': 0.0,
+        'streaming': False,
     }
 
     def __init__(self, gui, *args, **kwargs):
@@ -152,6 +542,14 @@ class ViewModel(object):
         for var, value in zip(self.gui._ph_grid, values):
             var.set(value)
 
+    @property
+    def ph_adaptive(self):
+        return bool(self.gui._ph_adaptive.get())
+
+    @ph_adaptive.setter
+    def ph_adaptive(self, value):
+        self.gui._ph_adaptive.set(value)
+
     @property
     def ph_reference(self):
         return self.gui._ph_reference.get()
@@ -208,46 +606,261 @@ class ViewModel(object):
     def chains(self, value):
         self.gui._chains.set(value)
 
+    @property
+    def chains_buffer(self):
+        try:
+            return max(0.0, float(self.gui._chains_buffer.get()))
+        except (ValueError, TclError):
+            return 0.0
+
+    @chains_buffer.setter
+    def chains_buffer(self, value):
+        self.gui._chains_buffer.set(value)
+
+    @property
+    def processes(self):
+        try:
+            return max(1, int(self.gui._processes.get()))
+        except (ValueError, TclError):
+            return 1
+
+    @processes.setter
+    def processes(self, value):
+        self.gui._processes.set(value)
+
+    @property
+    def use_cache(self):
+        return bool(self.gui._use_cache.get())
+
+    @use_cache.setter
+    def use_cache(self, value):
+        self.gui._use_cache.set(value)
+
+    @property
+    def trajectory(self):
+        return bool(self.gui._trajectory.get())
+
+    @trajectory.setter
+    def trajectory(self, value):
+        self.gui._trajectory.set(value)
+
+    @property
+    def frames(self):
+        try:
+            start, stop, stride = [int(var.get()) for var in self.gui._frames]
+        except (ValueError, TclError):
+            return 1, 0, 1
+        return start, stop, max(1, stride)
+
+    @frames.setter
+    def frames(self, values):
+        for var, value in zip(self.gui._frames, values):
+            var.set(value)
+
+    @property
+    def reuse_tolerance(self):
+        try:
+            return max(0.0, float(self.gui._reuse_tolerance.get()))
+        except (ValueError, TclError):
+            return 0.0
+
+    @reuse_tolerance.setter
+    def reuse_tolerance(self, value):
+        self.gui._reuse_tolerance.set(value)
+
+    @property
+    def streaming(self):
+        return bool(self.gui._streaming.get())
+
+    @streaming.setter
+    def streaming(self, value):
+        self.gui._streaming.set(value)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobFeed(object):
 
-def propka_run(pdb, cli_options):
     """
-    Run a PropKa job and get all values back programmatically.
+    (name, atom records) jobs for `Controller._run_jobs`, exported from
+    Chimera incrementally.
+
+    Chimera objects can only be used from the main thread, but reading the
+    coordinates of thousands of frames in one go would freeze it. Instead,
+    `start` schedules `after` callbacks that read one frame at a time, for
+    at most `budget` seconds per callback, and hand the coordinates to the
+    worker thread as arrays. The worker builds the atom records (and
+    applies the chain restriction) while iterating over the feed.
+
+    Parameters
+    ----------
+    master : Tkinter widget
+        Widget used to schedule the export callbacks.
+    specs : list of (molecule, name, coordset)
+        Jobs to export. A None `coordset` uses the current coordinates.
+    chains, buffer : optional
+        As in `Controller.atom_records`.
+    budget : float, optional
+        Seconds of main thread time used per callback.
+    backlog : int, optional
+        Exported frames waiting for the worker. Export pauses while the
+        backlog is full, so frames are never all held in memory.
+    """
+
+    def __init__(self, master, specs, chains=None, buffer=0.0, budget=0.05, backlog=8):
+        self.master = master
+        self.specs = specs
+        self.chains = chains
+        self.buffer = buffer
+        self.budget = budget
+        self._templates = {}  # molecule -> records with the current coordinates
+        self._queue = Queue.Queue(backlog)
+        self._next = 0
+        self._cancelled = threading.Event()
+        self._error = None  # raised in the worker once the queued frames are used
+
+    def __len__(self):
+        return len(self.specs)
+
+    def start(self):
+        self.master.after_idle(self._export)
+
+    def cancel(self):
+        self._cancelled.set()
+        self._templates.clear()
+        with self._queue.mutex:
+            self._queue.queue.clear()
+
+    def _export(self):
+        started = time.time()
+        while self._next < len(self.specs) and not self._cancelled.is_set():
+            if self._queue.full():
+                self.master.after(50, self._export)
+                return
+            molecule, name, coordset = self.specs[self._next]
+            try:
+                if molecule not in self._templates:
+                    self._templates[molecule] = Controller.atom_records(molecule)
+                xyz = None if coordset is None else Controller.coordinates(molecule, coordset)
+            except Exception as e:  # e.g. the molecule was closed mid-run
+                self._error = e
+                self._cancelled.set()
+                return
+            self._queue.put((molecule, name, xyz))
+            self._next += 1
+            if time.time() - started > self.budget:
+                self.master.after(1, self._export)
+                return
+
+    def __iter__(self):
+        for _ in range(len(self.specs)):
+            while True:
+                try:
+                    molecule, name, xyz = self._queue.get(timeout=0.5)
+                    break
+                except Queue.Empty:
+                    if self._error is not None:
+                        raise self._error
+                    if self._cancelled.is_set():
+                        raise JobCancelled('Export cancelled')
+            records = self._templates.get(molecule)
+            if records is None:  # released by `cancel`
+                raise JobCancelled('Export cancelled')
+            if xyz is not None:
+                records = with_coordinates(records, xyz)
+            if self.chains:
+                records = restrict_to_chains(records, self.chains, buffer=self.buffer)
+            yield name, records
+
+
+class Worker(threading.Thread):
+
+    """
+    Run `target` in a background thread, keeping the Tk main loop free.
+
+    The worker never touches Tk or Chimera. Instead, it pushes messages to a
+    queue that is drained periodically from the main loop with `after`, where
+    the `progress`, `callback` and `errback` functions are finally called.
 
     Parameters
     ----------
-    pdb : str
-        Path to PDB file that contains the molecule to be analyzed.
-    cli_options : list of str
-        List of arguments that would have been passed in a CLI environment.
+    target : callable
+        Function to run. It must accept a `progress` keyword argument, which
+        will receive a function that takes a message string. Calling it
+        raises `JobCancelled` if `cancel()` was requested.
+    args, kwargs : tuple, dict
+        Additional arguments for `target`.
+    master : Tkinter widget
+        Widget used to schedule the polling callbacks.
+    callback : callable
+        Called with the value returned by `target`.
+    errback : callable
+        Called with the raised exception and its formatted traceback.
+    progress : callable
+        Called with each progress message reported by `target`.
+    poll_interval : int
+        Milliseconds between queue checks.
     """
-    args, _ = propka.lib.loadOptions(*cli_options)
-    propka_mol = propka.molecular_container.Molecular_container(pdb, args)
-
-    residues_pka, residues_charge = {}, {}
-    for name, conformation in propka_mol.conformations.items():
-        conformation.calculate_pka(propka_mol.version, propka_mol.options)
-        for group in conformation.groups:
-            key = group.residue_type, group.atom.resNumb, group.atom.chainID
-            residues_pka[key] = group.pka_value
-            residues_charge[key] = group.charge
-
-    propka_mol.find_non_covalently_coupled_groups()
-    propka_mol.average_of_conformations()
-
-    charge_profile = propka_mol.getChargeProfile(grid=args.grid)
-    folded_pi, unfolded_pi = propka_mol.getPI(grid=args.grid)
-    folding_profile, (pH_opt, dG_opt), (dG_min, dG_max), (pH_min, pH_max) = \
-        propka_mol.getFoldingProfile(reference=args.reference, grid=args.grid)
-
-    return {'residues_pka': residues_pka,
-            'residues_charge': residues_charge,
-            'charge_profile': charge_profile,
-            'pi_folded': folded_pi,
-            'pi_unfolded': unfolded_pi,
-            'folding_profile': folding_profile,
-            'pH_opt': pH_opt,
-            'dG_opt': dG_opt,
-            'dG_min': dG_min,
-            'dG_max': dG_max,
-            'pH_min': pH_min,
-            'pH_max': pH_max}
+
+    def __init__(self, target, args=(), kwargs=None, master=None, callback=None,
+                 errback=None, progress=None, poll_interval=100):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.master = master
+        self.callback = callback
+        self.errback = errback
+        self.progress = progress
+        self.poll_interval = poll_interval
+        self._queue = Queue.Queue()
+        self._cancelled = threading.Event()
+
+    def start(self):
+        super(Worker, self).start()
+        self.master.after(self.poll_interval, self._poll)
+
+    def run(self):
+        try:
+            result = self.target(*self.args, progress=self._report, **self.kwargs)
+        except Exception as e:
+            self._queue.put(('error', (e, traceback.format_exc())))
+        else:
+            self._queue.put(('done', result))
+
+    def cancel(self):
+        self._cancelled.set()
+        self._templates.clear()
+        with self._queue.mutex:
+            self._queue.queue.clear()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _report(self, message):
+        if self.cancelled:
+            raise JobCancelled(message)
+        self._queue.put(('progress', message))
+
+    def _poll(self):
+        while True:
+            try:
+                kind, payload = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if kind == 'progress':
+                if self.progress is not None:
+                    self.progress(payload)
+            elif kind == 'done':
+                if self.callback is not None:
+                    self.callback(payload)
+                return
+            elif kind == 'error':
+                if self.errback is not None:
+                    self.errback(*payload)
+                return
+        self.master.after(self.poll_interval, self._poll)
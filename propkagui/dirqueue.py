@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+File-based work queue to spread PropKa jobs across machines.
+
+All coordination happens through a directory on a shared filesystem, so no
+broker is needed::
+
+    <root>/pending/<job>.json             waiting to be processed
+    <root>/claimed/<job>.json@<worker>    being processed by <worker>
+    <root>/done/<job>.json                finished (successfully or not)
+    <root>/workers/<worker>.heartbeat     touched periodically by live workers
+    <root>/results/<worker>.jsonl         one JSON line per finished job
+
+Workers claim jobs by renaming them from ``pending`` to ``claimed``, which is
+atomic within a filesystem, so each job goes to exactly one worker. While
+busy, a worker keeps touching its heartbeat file; claims whose worker has not
+beaten for longer than the lease are moved back to ``pending`` by any other
+worker, up to a maximum number of attempts, after which the job is marked
+as failed (so an input that crashes its worker cannot take down every node
+in turn). Each worker appends to its own results shard, so writers never
+contend. Since a requeued job may still be finished by a slow worker, the
+same job can appear twice in the shards; `DirectoryQueue.results` keeps only
+one of them.
+
+Workers list ``pending`` once and then claim from that listing, starting at
+a random point, until it is used up, so they neither list the directory
+for every job nor all race for the same first entry.
+
+Heartbeats are compared against the local clock, so the lease must be
+generous compared to the clock skew between nodes.
+
+Usage::
+
+    tangram_propka_queue submit /shared/queue 'structures/*.pdb' --propka "-o 7.4"
+    tangram_propka_queue work /shared/queue -j 8        # on every node
+    tangram_propka_queue status /shared/queue
+    tangram_propka_queue collect /shared/queue -o results.jsonl
+"""
+
+from __future__ import print_function, division
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import sys
+import threading
+import time
+from .cli import expand_inputs, _safe_job
+
+
+STATES = ('pending', 'claimed', 'done')
+
+
+class DirectoryQueue(object):
+
+    """
+    Parameters
+    ----------
+    root : str
+        Queue directory, shared by all the nodes.
+    lease : float, optional
+        Seconds without heartbeats after which a claimed job is considered
+        abandoned and requeued.
+    max_attempts : int, optional
+        Claims abandoned after which a job is marked as failed instead of
+        requeued again.
+    """
+
+    def __init__(self, root, lease=600.0, max_attempts=3):
+        self.root = root
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._listing = []  # pending names not tried yet by this worker
+        for name in STATES + ('workers', 'results'):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:  # created concurrently by another node
+                    if not os.path.isdir(path):
+                        raise
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    @staticmethod
+    def job_id(path, options):
+        """
+        Deterministic id, so submitting the same input twice is a no-op.
+        """
+        sha = hashlib.sha1()
+        sha.update(os.path.abspath(path).encode('utf-8'))
+        sha.update(b'\0'.join(o.encode('utf-8') for o in options))
+        return sha.hexdigest()[:16]
+
+    def _known(self):
+        known = set()
+        for state in STATES:
+            for name in os.listdir(self._path(state)):
+                known.add(name.split('.', 1)[0])
+        return known
+
+    def submit(self, paths, options=()):
+        """
+        Add one job per input path. Jobs already in the queue, in any
+        state, are skipped.
+
+        Returns
+        -------
+        list of str
+            Ids of the newly submitted jobs.
+        """
+        options = list(options)
+        known = self._known()
+        submitted = []
+        for path in paths:
+            job_id = self.job_id(path, options)
+            if job_id in known:
+                continue
+            job = {'id': job_id, 'input': os.path.abspath(path), 'options': options}
+            tmp = self._path('pending', '.{}.tmp'.format(job_id))
+            with open(tmp, 'w') as f:
+                json.dump(job, f)
+            os.rename(tmp, self._path('pending', job_id + '.json'))
+            known.add(job_id)
+            submitted.append(job_id)
+        return submitted
+
+    def claim(self, worker):
+        """
+        Atomically take one pending job for `worker`.
+
+        Candidates come from a shuffled listing of ``pending`` that is only
+        refreshed once used up, so workers spread over different jobs.
+
+        Returns
+        -------
+        dict or None
+            The job description, or None if nothing is pending.
+        """
+        fresh = not self._listing
+        if fresh:
+            self._list_pending()
+        job = self._claim_listed(worker)
+        if job is None and not fresh:  # the listing went stale
+            self._list_pending()
+            job = self._claim_listed(worker)
+        return job
+
+    def _list_pending(self):
+        self._listing = [n for n in os.listdir(self._path('pending')) if n.endswith('.json')]
+        random.shuffle(self._listing)
+
+    def _claim_listed(self, worker):
+        while self._listing:
+            name = self._listing.pop()
+            claimed = self._path('claimed', '{}@{}'.format(name, worker))
+            try:
+                os.rename(self._path('pending', name), claimed)
+            except OSError:  # another worker was faster
+                continue
+            with open(claimed) as f:
+                job = json.load(f)
+            job['claim'] = claimed
+            return job
+        return None
+
+    def heartbeat(self, worker):
+        path = self._path('workers', worker + '.heartbeat')
+        with open(path, 'a'):
+            os.utime(path, None)
+
+    def alive(self, worker, now=None):
+        try:
+            last = os.path.getmtime(self._path('workers', worker + '.heartbeat'))
+        except OSError:
+            return False
+        return (now or time.time()) - last <= self.lease
+
+    def complete(self, job, worker, record):
+        """
+        Append `record` to the results shard of `worker` and mark `job` as done.
+        """
+        record = dict(record, id=job['id'])
+        with open(self._path('results', worker + '.jsonl'), 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(job['claim'], self._path('done', job['id'] + '.json'))
+        except OSError:  # requeued meanwhile; it will be run again
+            pass
+
+    def requeue_stale(self, worker='requeue'):
+        """
+        Move claims of workers that stopped beating back to ``pending``.
+        Jobs abandoned `max_attempts` times are marked as done instead, with
+        an error record in the results shard of `worker`.
+
+        Returns
+        -------
+        list of str
+            Ids of the requeued jobs.
+        """
+        now = time.time()
+        requeued = []
+        for name in os.listdir(self._path('claimed')):
+            filename, _, owner = name.partition('@')
+            if not owner or self.alive(owner, now):
+                continue
+            # Move it aside first, so only one worker handles each claim
+            taken = self._path('claimed', '.{}.requeue'.format(filename))
+            try:
+                os.rename(self._path('claimed', name), taken)
+            except OSError:  # finished or requeued by someone else
+                continue
+            with open(taken) as f:
+                job = json.load(f)
+            job['attempts'] = job.get('attempts', 0) + 1
+            if job['attempts'] >= self.max_attempts:
+                job['claim'] = taken
+                self.complete(job, worker, {
+                    'input': job['input'],
+                    'error': 'Abandoned by its worker {} times'.format(job['attempts'])})
+                continue
+            with open(taken, 'w') as f:
+                json.dump(job, f)
+            os.rename(taken, self._path('pending', filename))
+            requeued.append(job['id'])
+        return requeued
+
+    def status(self):
+        counts = dict((state, len([n for n in os.listdir(self._path(state))
+                                   if not n.startswith('.')]))
+                      for state in STATES)
+        counts['workers'] = len([n for n in os.listdir(self._path('workers'))
+                                 if self.alive(n[:-len('.heartbeat')])])
+        return counts
+
+    def results(self):
+        """
+        Iterate over the records of all shards, one per job.
+        """
+        records = {}
+        shards = self._path('results')
+        for name in sorted(os.listdir(shards)):
+            if not name.endswith('.jsonl'):
+                continue
+            with open(os.path.join(shards, name)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # truncated last line of a killed worker
+                        continue
+                    records[record['id']] = record
+        return records.values()
+
+
+class _Heartbeat(threading.Thread):
+
+    def __init__(self, queue, worker):
+        super(_Heartbeat, self).__init__()
+        self.daemon = True
+        self.queue, self.worker = queue, worker
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease / 4.0):
+            self.queue.heartbeat(self.worker)
+
+
+def work(root, worker=None, lease=600.0, poll=10.0, wait=False, max_attempts=3):
+    """
+    Process jobs from the queue at `root` until none are left.
+
+    Parameters
+    ----------
+    worker : str, optional
+        Unique worker name. Defaults to ``<hostname>-<pid>``.
+    poll : float, optional
+        Seconds to sleep when no job is pending but others are still claimed
+        (they may be requeued if their worker dies).
+    wait : bool, optional
+        Keep polling for new submissions even when the queue is drained.
+    max_attempts : int, optional
+        As in `DirectoryQueue`.
+
+    Returns
+    -------
+    int
+        Number of jobs processed by this worker.
+    """
+    queue = DirectoryQueue(root, lease=lease, max_attempts=max_attempts)
+    worker = worker or '{}-{}'.format(socket.gethostname(), os.getpid())
+    queue.heartbeat(worker)
+    beat = _Heartbeat(queue, worker)
+    beat.start()
+    processed = 0
+    last_requeue = 0.0
+    try:
+        while True:
+            # Stale claims can only appear once a lease expires: no need to
+            # list ``claimed`` for every job
+            if time.time() - last_requeue > lease / 4.0:
+                queue.requeue_stale(worker)
+                last_requeue = time.time()
+            job = queue.claim(worker)
+            if job is None:
+                status = queue.status()
+                if not wait and not status['pending'] and not status['claimed']:
+                    return processed
+                time.sleep(poll)
+                continue
+            name = os.path.basename(job['input'])
+            _, record = _safe_job((0, (name, job['input']), job['options']))
+            queue.complete(job, worker, record)
+            processed += 1
+            print('[{}] {}: {}'.format(worker, job['input'],
+                                       'failed' if 'error' in record else 'done'),
+                  file=sys.stderr)
+    finally:
+        beat.stopped.set()
+        try:
+            os.remove(queue._path('workers', worker + '.heartbeat'))
+        except OSError:
+            pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='tangram_propka_queue',
+                                     description='Distributed PropKa runs over a shared directory.')
+    commands = parser.add_subparsers(dest='command')
+
+    submit = commands.add_parser('submit', help='add PDB files to the queue')
+    submit.add_argument('root')
+    submit.add_argument('inputs', nargs='*', metavar='PDB')
+    submit.add_argument('-l', '--list', dest='list_file', metavar='FILE')
+    submit.add_argument('--propka', default='', metavar='ARGS',
+                        help='extra PropKa options, as a single quoted string')
+
+    worker = commands.add_parser('work', help='process queued jobs on this node')
+    worker.add_argument('root')
+    worker.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count())
+    worker.add_argument('--lease', type=float, default=600.0,
+                        help='seconds without heartbeat before a claim is requeued')
+    worker.add_argument('--poll', type=float, default=10.0)
+    worker.add_argument('--max-attempts', type=int, default=3,
+                        help='abandoned claims after which a job is marked as failed')
+    worker.add_argument('--wait', action='store_true',
+                        help='keep waiting for new jobs when the queue is empty')
+
+    status = commands.add_parser('status', help='show job counts')
+    status.add_argument('root')
+
+    collect = commands.add_parser('collect', help='merge result shards into one JSON lines file')
+    collect.add_argument('root')
+    collect.add_argument('-o', '--output', default='-', metavar='FILE')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'submit':
+        queue = DirectoryQueue(args.root)
+        paths = expand_inputs(args.inputs, args.list_file)
+        submitted = queue.submit(paths, ['-q'] + shlex.split(args.propka))
+        print('Submitted {} of {} jobs'.format(len(submitted), len(paths)), file=sys.stderr)
+    elif args.command == 'work':
+        kwargs = dict(root=args.root, lease=args.lease, poll=args.poll, wait=args.wait,
+                      max_attempts=args.max_attempts)
+        if args.processes <= 1:
+            work(**kwargs)
+        else:
+            workers = [multiprocessing.Process(target=work, kwargs=kwargs)
+                       for _ in range(args.processes)]
+            for process in workers:
+                process.start()
+            for process in workers:
+                process.join()
+    elif args.command == 'status':
+        print(json.dumps(DirectoryQueue(args.root).status(), sort_keys=True))
+    elif args.command == 'collect':
+        output = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            for record in DirectoryQueue(args.root).results():
+                output.write(json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    else:
+        parse_args(['--help'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Chimera-independent PropKa execution engine.
+
+Everything needed to run PropKa programmatically and collect its results
+lives here, so it can be used both from the Chimera GUI (see `core`) and
+headless, e.g. from the `cli` entry point on compute nodes.
+"""
+
+from __future__ import print_function, division
+import contextlib
+import functools
+import multiprocessing
+import shutil
+import tempfile
+import threading
+try:
+    from StringIO import StringIO
+    string_types = basestring,
+except ImportError:  # Python 3
+    from io import StringIO
+    string_types = str,
+import propka
+import propka.lib
+import propka.parameters
+from .container import PropkaContainer
+from .profiles import snapshot_groups, ph_profiles, titration_curves
+from .reuse import EnvironmentCache
+from .results import PropkaResults
+from ._version import get_versions
+
+
+def parse_chains(text):
+    """
+    Chain IDs from user input such as ``'A,B'``, ``'A B'`` or ``'AB'``.
+    """
+    tokens = text.replace(',', ' ').split()
+    if len(tokens) == 1 and len(tokens[0]) > 1:
+        tokens = list(tokens[0])
+    return tokens
+
+
+def split_profile_options(options):
+    """
+    Separate the options that only affect the pH profiles (grid, window and
+    reference) from those that affect the pKa values themselves.
+
+    Returns
+    -------
+    pka_options : list
+        `options` without the pH profile related arguments.
+    profile_options : dict
+        `grid` and `reference` keyword arguments for `profiles.ph_profiles`.
+    """
+    args, _ = propka.lib.loadOptions(*options)
+    nargs = {'-w': 3, '--window': 3, '-g': 3, '--grid': 3, '-r': 1, '--reference': 1}
+    pka_options = []
+    options = list(options)
+    while options:
+        option = options.pop(0)
+        if option in nargs:
+            del options[:nargs[option]]
+        else:
+            pka_options.append(option)
+    return pka_options, {'grid': args.grid, 'reference': args.reference}
+
+
+def cache_version():
+    """
+    Version tag for cached results: plugin version plus PropKa version.
+    """
+    try:
+        import pkg_resources
+        propka_version = pkg_resources.get_distribution('propka').version
+    except Exception:
+        propka_version = getattr(propka, '__version__', 'unknown')
+    return '{}-propka{}'.format(get_versions()['version'], propka_version)
+
+
+_environment_caches = {}
+
+
+def environment_cache(tolerance):
+    """
+    `EnvironmentCache` shared by all the jobs of this process with the same
+    `tolerance`, so pool workers keep reusing environments between tasks.
+    """
+    if tolerance not in _environment_caches:
+        _environment_caches[tolerance] = EnvironmentCache(tolerance)
+    return _environment_caches[tolerance]
+
+
+def _pool_job(task, reuse_tolerance=None):
+    """
+    Multiprocessing-friendly wrapper around `propka_run`.
+    """
+    i, (name, pdb), options = task
+    reuse = environment_cache(reuse_tolerance) if reuse_tolerance is not None else None
+    return i, propka_run(pdb, options, name=name, reuse=reuse)
+
+
+def run_many(jobs, options, processes=1, function=_pool_job, reuse_tolerance=None, count=None):
+    """
+    Run `propka_run` for each (name, pdb) pair in `jobs`, serially or across
+    a pool of `processes` processes.
+
+    `jobs` may be a lazy iterable. It is then consumed only a few chunks
+    ahead of the completed jobs, so large batches are never held in memory
+    at once.
+
+    Parameters
+    ----------
+    count : int, optional
+        Number of jobs, if `jobs` has no length. An upper bound is enough.
+    function : callable, optional
+        Top-level function that receives ``(index, (name, pdb), options)``
+        tasks and returns ``(index, result)``.
+    reuse_tolerance : float, optional
+        Reuse desolvation terms of similar group environments (see
+        `reuse.EnvironmentCache`) across the jobs run by each process. Jobs
+        are then handed out in contiguous chunks, since neighbouring jobs
+        (e.g. trajectory frames) are the most likely to share environments.
+
+    Yields
+    ------
+    index, result
+        In completion order, not in submission order.
+    """
+    if count is None:
+        count = len(jobs)
+    chunksize = 1
+    if reuse_tolerance is not None:
+        function = functools.partial(function, reuse_tolerance=reuse_tolerance)
+        chunksize = max(1, count // (4 * max(1, processes)))
+    if processes <= 1 or count <= 1:
+        for task in enumerate(jobs):
+            yield function(task + (options,))
+        return
+
+    # The pool drains its task iterator from a helper thread as fast as it
+    # can, so throttle it to a window of tasks ahead of the yielded results.
+    # Errors raised by `jobs` would kill that thread: re-raise them here.
+    window = threading.Semaphore(2 * processes * chunksize)
+    state = {'stopped': False, 'error': None}
+
+    def tasks():
+        try:
+            for i, job in enumerate(jobs):
+                window.acquire()
+                if state['stopped']:
+                    return
+                yield i, job, options
+        except Exception as e:
+            state['error'] = e
+
+    pool = multiprocessing.Pool(min(processes, count))
+    try:
+        for item in pool.imap_unordered(function, tasks(), chunksize):
+            if state['error'] is not None:
+                raise state['error']
+            yield item
+            window.release()
+        if state['error'] is not None:
+            raise state['error']
+    finally:
+        state['stopped'] = True
+        window.release()  # unblock the task thread so it can exit
+        pool.terminate()
+        pool.join()
+
+
+@contextlib.contextmanager
+def scratch_directory(prefix='propka_'):
+    """
+    Private temporary directory for a single job, removed on exit.
+    """
+    path = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def propka_run(pdb, cli_options, progress=None, name=None, workdir=None, write_files=False,
+               reuse=None, profile_engine='numpy', adaptive_grid=False):
+    """
+    Run a PropKa job and get all values back programmatically.
+
+    Parameters
+    ----------
+    pdb : str, file-like or list of AtomRecord
+        Path to PDB file that contains the molecule to be analyzed, an
+        in-memory stream with its contents, or its atoms as returned by
+        `core.Controller.atom_records`. Streams and records are processed
+        without touching the filesystem.
+    cli_options : list of str
+        List of arguments that would have been passed in a CLI environment.
+    progress : callable, optional
+        Function that will receive a short message at each stage of the
+        calculation. It can abort the job by raising an exception.
+    name : str, optional
+        Name of the molecule when `pdb` is not a path.
+    workdir : str, optional
+        Directory for any file PropKa produces for this job. The current
+        working directory is never changed, so concurrent jobs are safe as
+        long as each one uses its own `workdir`. If not given, the job runs
+        in no-files mode: nothing is written at all, unless the PropKa
+        parameters request Marvin ligand typing (which needs mol2 files),
+        in which case a private scratch directory is used and removed
+        when the job ends.
+    write_files : bool, optional
+        Write the ``.propka_input`` and ``.pka`` files the PropKa CLI would
+        create into `workdir`, which must be given.
+    reuse : reuse.EnvironmentCache, optional
+        Reuse the desolvation terms of groups whose environment was already
+        seen by this cache. The results then include a ``reuse`` entry with
+        the number of titratable groups and how many of them were reused.
+    profile_engine : {'numpy', 'python', 'propka'}, optional
+        How the pH profiles and pI are computed from the final pKa values:
+        with `profiles.ph_profiles`, vectorized over the pH grid or point by
+        point, or with PropKa's own `getChargeProfile`, `getPI` and
+        `getFoldingProfile`. All three give the same profiles, but the
+        first two solve the pI by root finding
+        (`profiles.solve_isoelectric_points`), so it is not limited by the
+        resolution of the pH grid like PropKa's.
+    adaptive_grid : bool, optional
+        Evaluate the pH profiles on `profiles.adaptive_grid` points, refined
+        from the ``--grid`` option where the curves change fastest. Not
+        available with the ``'propka'`` profile engine.
+
+    Returns
+    -------
+    results.PropkaResults
+        Per-residue pKa values and charges, titratable groups, pH profiles,
+        titration curves and their key values. Behaves like a dict of those
+        entries.
+    """
+    if write_files and workdir is None:
+        raise ValueError('write_files requires a workdir')
+    if adaptive_grid and profile_engine == 'propka':
+        raise ValueError('adaptive_grid is not available with the propka profile engine')
+    if progress is None:
+        progress = lambda message: None
+
+    args, _ = propka.lib.loadOptions(*cli_options)
+    parameters = propka.parameters.Parameters(args.parameters)
+    if workdir is None and parameters.ligand_typing == 'marvin':
+        with scratch_directory() as scratch:
+            return propka_run(pdb, cli_options, progress=progress, name=name,
+                              workdir=scratch, reuse=reuse, profile_engine=profile_engine,
+                              adaptive_grid=adaptive_grid)
+
+    progress('Parsing structure')
+    if isinstance(pdb, string_types):
+        name = name or pdb
+        with open(pdb) as f:
+            pdb = StringIO(f.read())
+    propka_mol = PropkaContainer(pdb, args, name=name or 'molecule.pdb',
+                                 workdir=workdir or '', parameters=parameters)
+    if reuse is not None and not reuse.install(propka_mol.version):
+        reuse = None
+    if reuse is not None:
+        hits, misses = reuse.hits, reuse.misses
+
+    residues_pka, residues_charge = {}, {}
+    n_conformations = len(propka_mol.conformations)
+    for i, (name, conformation) in enumerate(propka_mol.conformations.items(), 1):
+        progress('Calculating pKa values (conformation {}/{})'.format(i, n_conformations))
+        conformation.calculate_pka(propka_mol.version, propka_mol.options)
+        for group in conformation.groups:
+            key = group.residue_type, group.atom.resNumb, group.atom.chainID
+            residues_pka[key] = group.pka_value
+            residues_charge[key] = group.charge
+
+    progress('Analyzing coupled groups')
+    propka_mol.find_non_covalently_coupled_groups()
+    propka_mol.average_of_conformations()
+
+    if args.chains:
+        # Neighbouring chains may have been kept as environment; do not report them
+        residues_pka = dict((k, v) for (k, v) in residues_pka.items() if k[2] in args.chains)
+        residues_charge = dict((k, v) for (k, v) in residues_charge.items() if k[2] in args.chains)
+        average = propka_mol.conformations['AVR']
+        average.groups = [g for g in average.groups if g.atom.chainID in args.chains]
+
+    progress('Computing pH profiles')
+    groups = snapshot_groups(propka_mol.conformations['AVR'])
+    if profile_engine == 'propka':
+        charge_profile = propka_mol.getChargeProfile(grid=args.grid)
+        folded_pi, unfolded_pi = propka_mol.getPI(grid=args.grid)
+        folding_profile, (pH_opt, dG_opt), (dG_min, dG_max), (pH_min, pH_max) = \
+            propka_mol.getFoldingProfile(reference=args.reference, grid=args.grid)
+        profiles = {'charge_profile': charge_profile,
+                    'pi_folded': folded_pi,
+                    'pi_unfolded': unfolded_pi,
+                    'folding_profile': folding_profile,
+                    'titration': titration_curves(groups, [p[0] for p in charge_profile]),
+                    'pH_opt': pH_opt,
+                    'dG_opt': dG_opt,
+                    'dG_min': dG_min,
+                    'dG_max': dG_max,
+                    'pH_min': pH_min,
+                    'pH_max': pH_max}
+    else:
+        profiles = ph_profiles(groups, grid=args.grid, reference=args.reference,
+                               engine=profile_engine, adaptive=adaptive_grid)
+
+    if write_files:
+        progress('Writing output files')
+        propka_mol.write_output_files(reference=args.reference)
+
+    results = PropkaResults(residues_pka, residues_charge, groups=groups, **profiles)
+    if reuse is not None:
+        reused = reuse.hits - hits
+        results['reuse'] = {'groups': reused + reuse.misses - misses, 'reused': reused}
+    return results
@@ -4,8 +4,12 @@
 
 from __future__ import print_function, division
 # Python stdlib
+import os
+import re
 import Tkinter as tk
+import tkFileDialog
 import Pmw
+from collections import OrderedDict
 from operator import itemgetter
 # Chimera stuff
 import chimera
@@ -13,6 +17,7 @@ from chimera.baseDialog import ModelessDialog
 from chimera.widgets import MoleculeScrolledListBox, SortableTable
 from ShowAttr import ShowAttrDialog
 # Additional 3rd parties
+import numpy as np
 import matplotlib
 matplotlib.use('TkAgg')
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
@@ -20,6 +25,8 @@ from matplotlib.figure import Figure
 # Own
 from libtangram.ui import TangramBaseDialog
 from core import Controller, ViewModel
+from columnar import save_results
+from results import PropkaResults
 
 
 ui = None
@@ -37,7 +44,7 @@ def showUI():
 
 class PropKaDialog(TangramBaseDialog):
 
-    buttons = ('Run', 'Close')
+    buttons = ('Run', 'Stop', 'Load', 'Close')
     default = None
     help = 'https://www.insilichem.com'
 
@@ -50,12 +57,20 @@ class PropKaDialog(TangramBaseDialog):
         self._ph_window = tk.DoubleVar(), tk.DoubleVar(), tk.DoubleVar()
         self._ph_grid = tk.DoubleVar(), tk.DoubleVar(), tk.DoubleVar()
         self._ph_reference = tk.StringVar()
+        self._ph_adaptive = tk.IntVar()
         self._mutations = tk.StringVar()
         self._mutations_method = tk.StringVar()
         self._mutations_options = tk.StringVar()
         self._titrate = tk.StringVar()
         self._keep_protons = tk.IntVar()
         self._chains = tk.StringVar()
+        self._chains_buffer = tk.DoubleVar()
+        self._processes = tk.IntVar()
+        self._use_cache = tk.IntVar()
+        self._trajectory = tk.IntVar()
+        self._frames = tk.IntVar(), tk.IntVar(), tk.IntVar()
+        self._reuse_tolerance = tk.DoubleVar()
+        self._streaming = tk.IntVar()
 
         # Fire up
         super(PropKaDialog, self).__init__(*args, **kwargs)
@@ -63,9 +78,10 @@ class PropKaDialog(TangramBaseDialog):
     def fill_in_ui(self, parent):
         self.canvas.columnconfigure(1, weight=1)
         # Molecules
-        self.ui_molecules_frame = tk.LabelFrame(self.canvas, text='Select a molecule')
+        self.ui_molecules_frame = tk.LabelFrame(self.canvas, text='Select molecules')
         self.ui_molecules_frame.grid(row=0, column=0, columnspan=2, sticky='ew', padx=5, pady=5)
-        self.ui_molecules = MoleculeScrolledListBox(self.ui_molecules_frame)
+        self.ui_molecules = MoleculeScrolledListBox(self.ui_molecules_frame,
+                                                    listbox_selectmode='extended')
         self.ui_molecules.pack(expand=True, fill='both', padx=3, pady=3)
 
         # Configuration
@@ -75,6 +91,7 @@ class PropKaDialog(TangramBaseDialog):
                 textvariable=self._chains, width=15)
         self.ui_chains_btn = tk.Button(self.ui_chains_frame, text='+')
         self.ui_chains = [self.ui_chains_entry, self.ui_chains_btn]
+        self.ui_chains_buffer = tk.Entry(self.canvas, textvariable=self._chains_buffer, width=6)
 
         ## pH
         self.ui_ph = tk.Scale(self.canvas, from_=0, to=14, resolution=0.1, orient='horizontal',
@@ -99,6 +116,7 @@ class PropKaDialog(TangramBaseDialog):
         self.ui_ph_reference = Pmw.OptionMenu(self.canvas,
                                     menubutton_textvariable=self._ph_reference,
                                     items=['neutral', 'low-pH'])
+        self.ui_ph_adaptive = tk.Checkbutton(self.canvas, variable=self._ph_adaptive, anchor='w')
 
         self.ui_titrate_frame = tk.Frame(self.canvas)
         self.ui_titrate_entry = tk.Entry(self.ui_titrate_frame, textvariable=self._titrate, width=15)
@@ -107,6 +125,16 @@ class PropKaDialog(TangramBaseDialog):
 
         self.ui_keep_protons = tk.Checkbutton(self.canvas, variable=self._keep_protons,
                                               anchor='w')
+        self.ui_processes = tk.Spinbox(self.canvas, textvariable=self._processes,
+                                       from_=1, to=256, width=6)
+        self.ui_use_cache = tk.Checkbutton(self.canvas, variable=self._use_cache, anchor='w')
+        self.ui_trajectory = tk.Checkbutton(self.canvas, variable=self._trajectory, anchor='w')
+        self.ui_frames_frame = tk.Frame(self.canvas)
+        self.ui_frames = [tk.Entry(self.ui_frames_frame, textvariable=var, width=6)
+                          for var in self._frames]
+        self.ui_reuse_tolerance = tk.Entry(self.canvas, textvariable=self._reuse_tolerance,
+                                           width=6)
+        self.ui_streaming = tk.Checkbutton(self.canvas, variable=self._streaming, anchor='w')
         self.ui_mutations = tk.Entry(self.canvas, textvariable=self._mutations)
         self.ui_mutations_method = tk.OptionMenu(self.canvas, self._mutations_method,
                                                   'alignment', 'scwrl', 'jackal')
@@ -114,21 +142,30 @@ class PropKaDialog(TangramBaseDialog):
 
         labeled_widgets = {
             (0, 'ui_chains_frame'): 'Chains',
-            (1, 'ui_ph') : 'pH',
-            (2, 'ui_ph_window_frame') : 'pH window',
-            (3, 'ui_ph_grid_frame') : 'pH grid',
-            (4, 'ui_ph_reference') : 'pH reference',
-            (5, 'ui_titrate_frame') : 'Titrate only',
-            (6, 'ui_keep_protons') : 'Keep protons',
-            # (7, 'ui_mutations'): 'Mutations',
-            # (8, 'ui_mutations_method'): 'Mutation method',
-            # (9, 'ui_mutations_options'): 'Mutation options',
+            (1, 'ui_chains_buffer'): u'Chains buffer (\u212B)',
+            (2, 'ui_ph') : 'pH',
+            (3, 'ui_ph_window_frame') : 'pH window',
+            (4, 'ui_ph_grid_frame') : 'pH grid',
+            (5, 'ui_ph_adaptive') : 'Adaptive pH grid',
+            (6, 'ui_ph_reference') : 'pH reference',
+            (7, 'ui_titrate_frame') : 'Titrate only',
+            (8, 'ui_keep_protons') : 'Keep protons',
+            (9, 'ui_processes') : 'Processes',
+            (10, 'ui_use_cache') : 'Use cache',
+            (11, 'ui_trajectory') : 'All frames (trajectory)',
+            (12, 'ui_frames_frame') : 'Frames (start, stop, step)',
+            (13, 'ui_reuse_tolerance') : u'Environment tolerance (\u212B)',
+            (14, 'ui_streaming') : 'Only keep statistics',
+            # (15, 'ui_mutations'): 'Mutations',
+            # (16, 'ui_mutations_method'): 'Mutation method',
+            # (17, 'ui_mutations_options'): 'Mutation options',
         }
         for (i, attr), title in sorted(labeled_widgets.items()):
             tk.Label(self.canvas, text=title).grid(row=i+1, column=0, sticky='e', padx=4, pady=1)
             getattr(self, attr).grid(row=i+1, column=1, padx=4, pady=1, sticky='we')
 
-        left_packed = self.ui_ph_window + self.ui_ph_grid + self.ui_chains + self.ui_titrate
+        left_packed = (self.ui_ph_window + self.ui_ph_grid + self.ui_chains + self.ui_titrate
+                       + self.ui_frames)
         for widget in left_packed:
             expand, fill = True, 'both'
             if isinstance(widget, tk.Button):
@@ -138,6 +175,12 @@ class PropKaDialog(TangramBaseDialog):
     def Run(self):
         pass
 
+    def Stop(self):
+        pass
+
+    def Load(self):
+        pass
+
     def Close(self):
         global ui
         ui = None
@@ -146,7 +189,7 @@ class PropKaDialog(TangramBaseDialog):
 
 class PropKaResultsDialog(TangramBaseDialog):
 
-    buttons = ('Close',)
+    buttons = ('Save', 'Close')
     _show_attr_dialog = None
     help = "https://github.com/insilichem/tangram_propkagui"
     VERSION = '0.0.1'
@@ -161,6 +204,10 @@ class PropKaResultsDialog(TangramBaseDialog):
         else:
             self.title = 'PropKa results'
         self._data = None
+        self._charges = {}  # molecule -> fractional charges at the slider pH
+        self._residue_indices = {}  # molecule -> Controller.residue_index
+        self._ph_update_id = None
+        self._apply_id = None
 
         self._original_colors = {}
 
@@ -170,7 +217,7 @@ class PropKaResultsDialog(TangramBaseDialog):
         self.canvas.columnconfigure(0, weight=1)
 
         self.ui_table_frame = tk.LabelFrame(master=self.canvas, text='Per-residue information')
-        self.ui_table = SortableTable(self.ui_table_frame)
+        self.ui_table = SortableTable(self.ui_table_frame, browseCmd=self._on_residue_selected)
         self.var_show_backbone_values = tk.IntVar()
         self.ui_show_bb_values_check = tk.Checkbutton(self.ui_table_frame,
             text='Show backbone values',
@@ -182,6 +229,19 @@ class PropKaResultsDialog(TangramBaseDialog):
         self.plot_widget = FigureCanvasTkAgg(self.plot_figure, master=self.ui_plot_frame)
         self.plot = self.plot_figure.add_subplot(111)
 
+        self.ui_titration_plot_frame = tk.LabelFrame(self.canvas,
+            text='Titration curves (select residues in the table)')
+        self.titration_figure = Figure(figsize=(4, 3), dpi=100, facecolor='#D9D9D9')
+        self.titration_widget = FigureCanvasTkAgg(self.titration_figure,
+                                                  master=self.ui_titration_plot_frame)
+        self.titration_plot = self.titration_figure.add_subplot(111)
+
+        self.ui_frames_plot_frame = tk.LabelFrame(self.canvas,
+            text='Per-frame information (select residues in the table)')
+        self.frames_figure = Figure(figsize=(4, 3), dpi=100, facecolor='#D9D9D9')
+        self.frames_widget = FigureCanvasTkAgg(self.frames_figure, master=self.ui_frames_plot_frame)
+        self.frames_plot = self.frames_figure.add_subplot(111)
+
         self.ui_actions_frame = tk.LabelFrame(self.canvas, text='Actions')
         self.ui_actions_0 = tk.Button(self.ui_actions_frame, text='Color by pKa',
                                       command=self.color_by_pka)
@@ -189,7 +249,13 @@ class PropKaResultsDialog(TangramBaseDialog):
                                       command=self.color_by_charge)
         self.ui_actions_2 = tk.Button(self.ui_actions_frame, text='Reset color',
                                       command=self.reset_colors)
-        self.ui_actions = [self.ui_actions_0, self.ui_actions_1, self.ui_actions_2]
+        self.var_ph = tk.DoubleVar()
+        self.var_ph.set(7.0)
+        self.ui_actions_3 = tk.Scale(self.ui_actions_frame, from_=0, to=14, resolution=0.1,
+                                     orient='horizontal', label='Charge at pH',
+                                     variable=self.var_ph, command=self._schedule_ph_update)
+        self.ui_actions = [self.ui_actions_0, self.ui_actions_1, self.ui_actions_2,
+                           self.ui_actions_3]
         self.ui_other_frame = tk.LabelFrame(self.canvas, text='Key pH values')
 
         # Pack and grid
@@ -206,13 +272,39 @@ class PropKaResultsDialog(TangramBaseDialog):
         self.plot_widget.get_tk_widget().configure(background='#D9D9D9', highlightcolor='#D9D9D9',
                                                    highlightbackground='#D9D9D9')
         self.plot_widget.get_tk_widget().pack(expand=True, fill='both')
+        self.titration_widget.get_tk_widget().configure(background='#D9D9D9',
+                                                        highlightcolor='#D9D9D9',
+                                                        highlightbackground='#D9D9D9')
+        self.titration_widget.get_tk_widget().pack(expand=True, fill='both')
+        self.frames_widget.get_tk_widget().configure(background='#D9D9D9',
+                                                     highlightcolor='#D9D9D9',
+                                                     highlightbackground='#D9D9D9')
+        self.frames_widget.get_tk_widget().pack(expand=True, fill='both')
 
     def fillInData(self, data):
-        # Fill in table
+        """
+        Parameters
+        ----------
+        data : OrderedDict
+            Maps each molecule to the results returned by `engine.propka_run`.
+        """
         self._data = data
+        self._residue_indices = {}
+        if self._charges:
+            self._compute_charges()
         self._populate_table(data)
         self._populate_plot(data)
         self._populate_other(data)
+        if any('titration' in results for results in data.values()):
+            self.ui_titration_plot_frame.grid(row=2, columnspan=3, sticky='news', padx=5, pady=5)
+            self._plot_titration([])
+        else:
+            self.ui_titration_plot_frame.grid_forget()
+        if any('trajectory' in results or 'statistics' in results for results in data.values()):
+            self.ui_frames_plot_frame.grid(row=3, columnspan=3, sticky='news', padx=5, pady=5)
+            self._plot_frames([])
+        else:
+            self.ui_frames_plot_frame.grid_forget()
 
     def _populate_table(self, data=None, show_backbone=None):
         if data is None:
@@ -220,18 +312,30 @@ class PropKaResultsDialog(TangramBaseDialog):
         if show_backbone is None:
             show_backbone = self.var_show_backbone_values.get()
 
+        multiple = len(data) > 1
         columns = [('#', itemgetter(0)), ('Residues', itemgetter(1)),
-                   ('pKa', itemgetter(2)), ('Charge', itemgetter(3))]
+                   ('pKa', itemgetter(2)), ('Charge', self._charge_of)]
+        if multiple:
+            columns.insert(0, ('Model', itemgetter(4)))
+        if any('residues_pka_std' in results for results in data.values()):
+            columns.insert(-1, ('pKa SD', itemgetter(5)))
         for column, fetcher in columns:
             self.ui_table.addColumn(column, fetcher, refresh=False)
         table_data = []
-        for residue, pka in data['residues_pka'].items():
-            restype, respos, chainid = residue
-            if not show_backbone and restype in ('BBC', 'BBN'):
-                continue
-            charge = data['residues_charge'][residue]
-            key = ':{}.{} {}'.format(respos, chainid, restype)
-            table_data.append((respos, key, pka, charge))
+        for molecule, results in data.items():
+            results = PropkaResults.from_dict(results)
+            keep = np.ones(len(results.residues), dtype=bool)
+            if not show_backbone:
+                keep = ~np.in1d(results.type_names(), ('BBC', 'BBN'))
+            residues = results.keys_list()
+            pkas = results.residues['pka'].tolist()
+            charges = self._charges.get(molecule, results.residues['charge']).tolist()
+            std = results.get('residues_pka_std', {})
+            for i in np.flatnonzero(keep).tolist():
+                residue = restype, respos, chainid = residues[i]
+                key = ':{}.{} {}'.format(respos, chainid, restype)
+                table_data.append((respos, key, pkas[i], charges[i], molecule.name,
+                                   std.get(residue), residue, molecule, i))
 
         self.ui_table.setData(sorted(table_data))
         try:
@@ -239,14 +343,27 @@ class PropKaResultsDialog(TangramBaseDialog):
         except tk.TclError:
             self.ui_table.refresh(rebuild=True)
 
+    def _charge_of(self, row):
+        # Charge column: follows the slider pH without rebuilding the table
+        charges = self._charges.get(row[7])
+        return row[3] if charges is None else float(charges[row[8]])
+
     def _populate_plot(self, data):
-        charge_x, charge_y = zip(*data['charge_profile'])[:2]
-        self.plot.plot(charge_x, charge_y, 'b', label='Charge')
+        self.plot.clear()
+        multiple = len(data) > 1
+        for molecule, results in data.items():
+            suffix = ' ({})'.format(molecule.name) if multiple else ''
+            charge_x, charge_y = zip(*results['charge_profile'])[:2]
+            folding_x, folding_y = zip(*results['folding_profile'])
+            if multiple:
+                line, = self.plot.plot(charge_x, charge_y, '-', label='Charge' + suffix)
+                self.plot.plot(folding_x, folding_y, '--', color=line.get_color(),
+                               label='dG' + suffix)
+            else:
+                self.plot.plot(charge_x, charge_y, 'b', label='Charge')
+                self.plot.plot(folding_x, folding_y, 'r', label='dG')
         self.plot.set_xlabel('pH')
 
-        folding_x, folding_y = zip(*data['folding_profile'])
-        self.plot.plot(folding_x, folding_y, 'r', label='dG')
-
         self.plot_figure.subplots_adjust(bottom=0.15)
         self.plot.patch.set_visible(False)
         legend = self.plot.legend(loc='upper right', handlelength=2, fancybox=True)
@@ -258,6 +375,76 @@ class PropKaResultsDialog(TangramBaseDialog):
         self.plot_widget.show()
 
 
+    def _on_residue_selected(self, selection):
+        # Depending on the selection mode, we get a single row or a list of rows
+        if isinstance(selection, tuple) and selection and not isinstance(selection[0], tuple):
+            selection = [selection]
+        self._plot_titration(selection or [])
+        self._plot_frames(selection or [])
+
+    def _plot_titration(self, rows):
+        """
+        Titration curves of the residues in the selected table `rows`, taken
+        from the matrix stored with the results.
+        """
+        self.titration_plot.clear()
+        for row in rows:
+            residue, molecule = row[6], row[7]
+            titration = self._data.get(molecule, {}).get('titration')
+            if titration is None or residue not in titration['residues']:
+                continue
+            label = row[1] if len(self._data) == 1 else '{} {}'.format(molecule.name, row[1])
+            row_index = titration['residues'].index(residue)
+            self.titration_plot.plot(titration['ph'], titration['charge'][row_index], '-',
+                                     label=label)
+        self.titration_plot.set_xlabel('pH')
+        self.titration_plot.set_ylabel('Charge')
+        self.titration_plot.patch.set_visible(False)
+        self.titration_figure.subplots_adjust(bottom=0.2)
+        if rows:
+            legend = self.titration_plot.legend(loc='upper right', handlelength=2, fancybox=True)
+            legend.get_frame().set_alpha(0.5)
+            for label in legend.get_texts():
+                label.set_fontsize('small')
+        self.titration_widget.show()
+
+    def _plot_frames(self, rows):
+        """
+        pKa of the residues in the selected table `rows` along the trajectory,
+        or its distribution over frames if only statistics were kept.
+        """
+        self.frames_plot.clear()
+        histograms = False
+        for row in rows:
+            residue, molecule = row[6], row[7]
+            results = self._data.get(molecule, {})
+            label = row[1] if len(self._data) == 1 else '{} {}'.format(molecule.name, row[1])
+            trajectory, statistics = results.get('trajectory'), results.get('statistics')
+            if trajectory is not None and residue in trajectory['residues']:
+                column = trajectory['residues'].index(residue)
+                self.frames_plot.plot(trajectory['frames'], trajectory['pka'][:, column],
+                                      '.-', label=label)
+            elif statistics is not None and residue in statistics['residues']:
+                histograms = True
+                column = statistics['residues'].index(residue)
+                pka = statistics['pka']
+                self.frames_plot.step(pka['bins'][:-1], pka['histogram'][column],
+                                      where='post', label=label)
+        if histograms:
+            self.frames_plot.set_xlabel('pKa')
+            self.frames_plot.set_ylabel('Frames')
+        else:
+            self.frames_plot.set_xlabel('Frame')
+            self.frames_plot.set_ylabel('pKa')
+        self.frames_plot.patch.set_visible(False)
+        self.frames_figure.subplots_adjust(bottom=0.2)
+        if rows:
+            legend = self.frames_plot.legend(loc='upper right', handlelength=2, fancybox=True)
+            legend.get_frame().set_alpha(0.5)
+            for label in legend.get_texts():
+                label.set_fontsize('small')
+        self.frames_widget.show()
+
     def _populate_other(self, data):
         labels = {
             'pi_folded': 'pI (folded)',
@@ -270,23 +457,94 @@ class PropKaResultsDialog(TangramBaseDialog):
             'dG_max': u'Maximum \u0394G',
             }
 
-        for i, (key, label) in enumerate(sorted(labels.items())):
-            value = data.get(key)
-            value = '{:.2f}'.format(value) if value else 'N/A'
+        for widget in self.ui_other_frame.winfo_children():
+            widget.destroy()
+        offset = 0
+        if len(data) > 1:
+            offset = 1
+            for j, molecule in enumerate(data, 1):
+                tk.Label(self.ui_other_frame, text=molecule.name).grid(row=0, column=j,
+                    sticky='e', padx=5, pady=5)
+        for i, (key, label) in enumerate(sorted(labels.items()), offset):
             tk.Label(self.ui_other_frame, text=label + ':').grid(row=i, column=0, sticky='w',
                 padx=10, pady=5)
-            tk.Label(self.ui_other_frame, text=value).grid(row=i, column=1, sticky='e',
-                padx=5, pady=5)
+            for j, results in enumerate(data.values(), 1):
+                value = results.get(key)
+                value = '{:.2f}'.format(value) if value else 'N/A'
+                tk.Label(self.ui_other_frame, text=value).grid(row=i, column=j, sticky='e',
+                    padx=5, pady=5)
 
     def color_by_pka(self):
-        self.set_attr('pka', self._data['residues_pka'])
+        for molecule, results in self._data.items():
+            self.set_attr('pka', results['residues_pka'], molecule)
         self.render_by_attr('pka', colormap='Rainbow', histogram_values=[0, 14])
 
     def color_by_charge(self):
-        self.set_attr('charge', self._data['residues_charge'])
+        for molecule, results in self._data.items():
+            charges = results['residues_charge']
+            if molecule in self._charges:
+                results = PropkaResults.from_dict(results)
+                charges = dict(zip(results.keys_list(), self._charges[molecule].tolist()))
+            self.set_attr('charge', charges, molecule)
         self.render_by_attr('charge')
 
-    def set_attr(self, attr, values):
+    def _schedule_ph_update(self, *args):
+        # Debounced, so dragging the slider does not queue one update per step
+        master = self.uiMaster()
+        if self._ph_update_id is not None:
+            master.after_cancel(self._ph_update_id)
+        self._ph_update_id = master.after(200, self._update_ph)
+
+    def _compute_charges(self):
+        ph = self.var_ph.get()
+        self._charges = OrderedDict((molecule, PropkaResults.from_dict(results).charges_at(ph))
+                                    for (molecule, results) in self._data.items())
+
+    def _update_ph(self):
+        """
+        Show the fractional charges at the slider pH, computed from the pKa
+        values already available, in the table and on the structure.
+        """
+        self._ph_update_id = None
+        if not self._data:
+            return
+        self._compute_charges()
+        self.ui_table.refresh()
+        self._color_by_charges()
+
+    def _color_by_charges(self, limit=1.0):
+        """
+        Color residues by their charge at the slider pH directly, from blue
+        (-`limit`) to white to red (+`limit`), like the Blue-Red palette of
+        `render_by_attr` but without going through the Render by Attribute
+        dialog on every slider move.
+        """
+        for molecule, charges in self._charges.items():
+            keys = PropkaResults.from_dict(self._data[molecule]).keys_list()
+            t = np.clip(charges / limit, -1, 1)
+            rgb = np.ones((len(t), 3))
+            rgb[t < 0, :2] += t[t < 0, None]  # fade red and green towards blue
+            rgb[t > 0, 1:] -= t[t > 0, None]  # fade green and blue towards red
+            index = self._residue_index(molecule)
+            for (_, respos, chainid), color in zip(keys, rgb.tolist()):
+                color = chimera.MaterialColor(*(color + [1.0]))
+                for res in index.get((chainid, respos), ()):
+                    res.ribbonColor = color
+
+    def _residue_index(self, molecule):
+        index = self._residue_indices.get(molecule)
+        if index is None:
+            index = self._residue_indices[molecule] = Controller.residue_index(molecule)
+        return index
+
+    def set_attr(self, attr, values, molecule=None):
+        """
+        Set `attr` on the residues of `molecule` (or of all the molecules in
+        the dialog) from `values`, keyed by (residue_type, number, chain).
+        Residues are found through an index built once per results set.
+        """
+        molecules = [molecule] if molecule is not None else self.molecules
+        indices = [self._residue_index(m) for m in molecules]
         for key, value in values.items():
             if isinstance(value, list):
                 try:
@@ -294,9 +552,9 @@ class PropKaResultsDialog(TangramBaseDialog):
                 except IndexError:
                     value = None
             restype, respos, chainid = key
-            selection = chimera.specifier.evalSpec(':{}.{}'.format(respos, chainid))
-            for res in selection.residues():
-                setattr(res, attr, value)
+            for index in indices:
+                for res in index.get((chainid, respos), ()):
+                    setattr(res, attr, value)
 
     def render_by_attr(self, attr, colormap='Blue-Red', histogram_values=None):
         if self._show_attr_dialog is None:
@@ -311,8 +569,32 @@ class PropKaResultsDialog(TangramBaseDialog):
         d.setPalette(colormap)
         d.paletteMenu.setvalue(colormap)
         d.paletteMenu.invoke()
-        # Let the histogram end its calculations; otherwise errors will ocurr
-        d.uiMaster().after(500, d.Apply)
+        # Let the histogram end its calculations; otherwise errors will ocurr.
+        # Only the last request is applied if several arrive in the meantime.
+        master = d.uiMaster()
+        if self._apply_id is not None:
+            master.after_cancel(self._apply_id)
+        self._apply_id = master.after(500, self._apply_render)
+
+    def _apply_render(self):
+        self._apply_id = None
+        self._show_attr_dialog.Apply()
+
+    def Save(self):
+        """
+        Save the results as columnar stores (see `columnar`), one
+        subdirectory per molecule if there are several.
+        """
+        path = tkFileDialog.askdirectory(parent=self.uiMaster(), mustexist=False,
+                                         title='Save PropKa results to directory')
+        if not path:
+            return
+        for molecule, results in self._data.items():
+            target = path
+            if len(self._data) > 1:
+                target = os.path.join(path, re.sub(r'[^\w.-]+', '_', molecule.name))
+            save_results(target, results)
+        chimera.replyobj.status('PropKa results saved to {}'.format(path))
 
     def reset_colors(self):
         for m in self.molecules:
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Append-only journal of finished batch jobs, to resume interrupted runs.
+
+Every finished input is recorded as one JSON line with the hash of its
+contents and the normalized PropKa options it was run with. On restart,
+inputs whose path, contents and options match a successful entry are
+skipped, so a crash only costs the jobs that were in flight. Inputs that
+failed are skipped too unless retried explicitly, since their error is
+already in the output. Inputs that changed on disk, or are run with
+different options, are processed again.
+"""
+
+from __future__ import print_function, division
+import hashlib
+import json
+import os
+import time
+from .cache import normalize_options
+
+
+def file_digest(path, blocksize=1 << 20):
+    """
+    SHA1 of the contents of `path`.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def trim_partial_line(path, blocksize=1 << 16):
+    """
+    Truncate the JSON lines file `path` after its last newline, dropping a
+    line left half-written by a crash, so appending to it is safe again.
+    Missing files are ignored.
+    """
+    try:
+        f = open(path, 'rb+')
+    except IOError:
+        return
+    with f:
+        f.seek(0, os.SEEK_END)
+        end = position = f.tell()
+        while position > 0:
+            start = max(0, position - blocksize)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            f.truncate(position)
+
+
+class Manifest(object):
+
+    """
+    Parameters
+    ----------
+    path : str
+        JSON lines file. Created on first `record` if needed. A last line
+        left incomplete by a crash is removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        self._failed = set()
+        trim_partial_line(path)
+        self._load()
+
+    @staticmethod
+    def key(path, digest, options):
+        return os.path.abspath(path), digest, normalize_options(options)
+
+    def _load(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    key = self.key(entry['input'], entry['sha1'], entry['options'])
+                except (ValueError, KeyError, TypeError):  # corrupted by a crash
+                    continue
+                self._add(key, entry.get('status'))
+
+    def _add(self, key, status):
+        if status == 'done':
+            self._done.add(key)
+            self._failed.discard(key)
+        elif status == 'error':
+            self._failed.add(key)
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, path, digest, options):
+        return self.key(path, digest, options) in self._done
+
+    def is_failed(self, path, digest, options):
+        return self.key(path, digest, options) in self._failed
+
+    def record(self, path, digest, options, status='done'):
+        """
+        Append an entry and flush it to disk before returning.
+        """
+        entry = {'input': os.path.abspath(path), 'sha1': digest,
+                 'options': list(normalize_options(options)),
+                 'status': status, 'time': time.time()}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._add(self.key(path, digest, options), status)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+pH-dependent properties derived from already computed pKa values.
+
+Charge, pI and folding free energy profiles only depend on the final pKa
+values of the titratable groups, not on the structure, so they can be
+recomputed from a compact snapshot of those groups whenever the pH grid or
+the reference state change, without running PropKa again. The formulas
+mirror those in PropKa's `Group` and `Molecular_container` classes.
+
+Functions taking an `engine` argument can evaluate them point by point in
+pure Python (``'python'``, like PropKa does) or over the whole pH grid at
+once with NumPy (``'numpy'``), which stays fast on very fine grids.
+"""
+
+from __future__ import print_function, division
+import math
+from collections import namedtuple
+import numpy as np
+
+
+ADAPTIVE_TOLERANCE = 0.01
+
+
+TitratableGroup = namedtuple('TitratableGroup', 'residue_type number chain pka model_pka '
+                                                'charge ddg_neutral')
+
+
+def snapshot_groups(conformation):
+    """
+    Extract a picklable list of `TitratableGroup` from a PropKa conformation,
+    usually the averaged one (``propka_mol.conformations['AVR']``).
+    """
+    groups = []
+    for group in conformation.groups:
+        if not group.titratable:
+            continue
+        ddg_neutral = 0.0
+        if group.charge > 0.0:
+            pka_prime = group.pka_value
+            for determinant in group.determinants['coulomb']:
+                if determinant.value > 0.0:
+                    pka_prime -= determinant.value
+            ddg_neutral = -1.36 * (pka_prime - group.model_pka)
+        groups.append(TitratableGroup(group.residue_type, group.atom.resNumb,
+                                      group.atom.chainID, group.pka_value,
+                                      group.model_pka, group.charge, ddg_neutral))
+    return groups
+
+
+def make_grid(start, stop, step):
+    """
+    Same accumulation as `propka.lib.make_grid`, so grids match point by point.
+    """
+    x = start
+    while x <= stop:
+        yield x
+        x += step
+
+
+def group_arrays(groups):
+    """
+    pKa, model pKa, charge and neutral reference free energy of `groups`,
+    as one array each.
+    """
+    if not groups:
+        return tuple(np.zeros(0) for _ in range(4))
+    pka, model_pka, charge, ddg_neutral = np.array(
+        [(g.pka, g.model_pka, g.charge, g.ddg_neutral) for g in groups], dtype=float).T
+    return pka, model_pka, charge, ddg_neutral
+
+
+def charge_matrix(pka, charge, ph):
+    """
+    Henderson-Hasselbalch charge of each group (columns) at each pH (rows),
+    evaluated in a single broadcast operation.
+
+    ``charge * y / (1 + y)`` with ``y = 10 ** (charge * (pka - ph))`` is
+    computed as ``charge / (1 + 10 ** -x)``, which is equal but does not
+    turn into NaN when `y` overflows.
+    """
+    x = np.asarray(charge)[None, :] * (np.asarray(pka)[None, :] - np.asarray(ph)[:, None])
+    with np.errstate(over='ignore'):
+        return np.asarray(charge)[None, :] / (1.0 + 10.0 ** -x)
+
+
+def grid_points(grid):
+    """
+    pH values of a (start, stop, step) `grid`, as an array.
+    """
+    return np.array(list(make_grid(*grid)), dtype=float)
+
+
+def charge_profile_at(groups, ph):
+    """
+    (n, 3) array of [pH, unfolded charge, folded charge] for each value
+    of the array `ph`, which does not need to be evenly spaced.
+    """
+    pka, model_pka, charge, _ = group_arrays(groups)
+    unfolded = charge_matrix(model_pka, charge, ph).sum(axis=1)
+    folded = charge_matrix(pka, charge, ph).sum(axis=1)
+    return np.column_stack([ph, unfolded, folded])
+
+
+def titration_curves(groups, ph):
+    """
+    Titration curve of every group across the array `ph`, computed as a
+    single group x pH matrix.
+
+    Returns
+    -------
+    dict
+        ``residues``, the (residue_type, number, chain) key of each row,
+        ``ph`` and ``charge``, the matrix of group charges. The protonated
+        fraction of a group is its charge for bases and 1 + charge for acids.
+    """
+    ph = np.asarray(ph, dtype=float)
+    pka, _, charge, _ = group_arrays(groups)
+    return {'residues': [(g.residue_type, g.number, g.chain) for g in groups],
+            'ph': ph,
+            'charge': np.ascontiguousarray(charge_matrix(pka, charge, ph).T)}
+
+
+def charge_profile(groups, grid=(0., 14., .1), engine='python'):
+    """
+    List of [pH, unfolded charge, folded charge] for each pH in `grid`.
+    With ``engine='numpy'``, an (n, 3) array instead.
+    """
+    if engine == 'numpy':
+        return charge_profile_at(groups, grid_points(grid))
+    profile = []
+    for ph in make_grid(*grid):
+        unfolded = folded = 0.0
+        for group in groups:
+            y = 10 ** (group.charge * (group.model_pka - ph))
+            unfolded += group.charge * (y / (1.0 + y))
+            y = 10 ** (group.charge * (group.pka - ph))
+            folded += group.charge * (y / (1.0 + y))
+        profile.append([ph, unfolded, folded])
+    return profile
+
+
+def isoelectric_points(groups, grid=(0., 14., 1), iteration=0, engine='python'):
+    """
+    Folded and unfolded pI, refining the grid around the best point like
+    `Molecular_container.getPI` does.
+    """
+    if engine == 'numpy':
+        profile = charge_profile(groups, grid, engine=engine)
+        pi_folded = profile[np.argmin(np.abs(profile[:, 2]))].tolist()
+        pi_unfolded = profile[np.argmin(np.abs(profile[:, 1]))].tolist()
+    else:
+        pi_folded = pi_unfolded = [None, 1e6, 1e6]
+        for point in charge_profile(groups, grid):
+            pi_folded = min(pi_folded, point, key=lambda v: abs(v[2]))
+            pi_unfolded = min(pi_unfolded, point, key=lambda v: abs(v[1]))
+
+    pi_folded_value, pi_unfolded_value = pi_folded[0], pi_unfolded[0]
+    step = grid[2]
+    if (pi_folded[2] > 0.01 or pi_unfolded[1] > 0.01) and iteration < 4:
+        pi_folded_value, _ = isoelectric_points(
+            groups, [pi_folded[0] - step, pi_folded[0] + step, step / 10.0], iteration + 1,
+            engine=engine)
+        _, pi_unfolded_value = isoelectric_points(
+            groups, [pi_unfolded[0] - step, pi_unfolded[0] + step, step / 10.0], iteration + 1,
+            engine=engine)
+    return pi_folded_value, pi_unfolded_value
+
+
+def solve_isoelectric_points(group_lists, bracket=(0., 14.), xtol=1e-6):
+    """
+    Folded and unfolded pI of several structures at once, by bisection on
+    the net charge, which decreases monotonically with pH. Unlike
+    `isoelectric_points`, the precision does not depend on any pH grid.
+
+    Parameters
+    ----------
+    group_lists : list of list of TitratableGroup
+        Titratable groups of each structure.
+    bracket : (float, float), optional
+        pH interval to search. If the net charge does not change sign in
+        it, the end closest to neutrality is returned.
+    xtol : float, optional
+        Width of the final bracket.
+
+    Returns
+    -------
+    numpy.ndarray
+        (n, 2) array with the folded and unfolded pI of each structure.
+    """
+    width = max([len(groups) for groups in group_lists] + [0])
+    pka = np.zeros((len(group_lists), 2, width))
+    charge = np.zeros((len(group_lists), 1, width))  # padding groups have no charge
+    for i, groups in enumerate(group_lists):
+        folded, unfolded, q, _ = group_arrays(groups)
+        pka[i, 0, :len(groups)], pka[i, 1, :len(groups)] = folded, unfolded
+        charge[i, 0, :len(groups)] = q
+
+    def net_charge(ph):
+        x = charge * (pka - ph[..., None])
+        with np.errstate(over='ignore'):
+            return (charge / (1.0 + 10.0 ** -x)).sum(axis=-1)
+
+    start = np.full(pka.shape[:2], float(bracket[0]))
+    stop = np.full(pka.shape[:2], float(bracket[1]))
+    q_start, q_stop = net_charge(start), net_charge(stop)
+    low, high = start, stop
+    for _ in range(max(0, int(math.ceil(math.log((bracket[1] - bracket[0]) / xtol, 2))))):
+        middle = (low + high) / 2
+        positive = net_charge(middle) > 0
+        low = np.where(positive, middle, low)
+        high = np.where(positive, high, middle)
+    pi = (low + high) / 2
+    closest_end = np.where(np.abs(q_start) <= np.abs(q_stop), start, stop)
+    return np.where((q_start >= 0) & (q_stop <= 0), pi, closest_end)
+
+
+def folding_energy(groups, ph, reference='neutral'):
+    ddg = 0.0
+    for group in groups:
+        ddg_neutral = group.ddg_neutral if reference == 'neutral' else 0.0
+        q_pro = math.log10(1 + 10 ** (ph - group.pka))
+        q_mod = math.log10(1 + 10 ** (ph - group.model_pka))
+        ddg += ddg_neutral + -1.36 * (q_pro - q_mod)
+    return ddg
+
+
+def folding_energies(pka, model_pka, ddg_neutral, ph, reference='neutral'):
+    """
+    Folding free energy at each pH of the array `ph`, from the group arrays
+    returned by `group_arrays`, evaluated for all groups and pH values at once.
+    """
+    ph = np.asarray(ph, dtype=float)[:, None]
+    with np.errstate(over='ignore'):
+        q_pro = np.log10(1 + 10 ** (ph - np.asarray(pka)[None, :]))
+        q_mod = np.log10(1 + 10 ** (ph - np.asarray(model_pka)[None, :]))
+    ddg = -1.36 * (q_pro - q_mod).sum(axis=1)
+    if reference == 'neutral':
+        ddg += np.sum(ddg_neutral)
+    return ddg
+
+
+def _folding_summary_numpy(ph, ddg):
+    """
+    Vectorized counterpart of the optimum and ranges search in `folding_profile`.
+    """
+    opt = [None, 1e6]
+    if len(ddg):
+        best = int(np.argmin(ddg))
+        if ddg[best] < opt[1]:
+            opt = [float(ph[best]), float(ddg[best])]
+    range_80pct = [None, None]
+    within_80pct = ph[ddg < 0.8 * opt[1]]
+    if len(within_80pct):
+        range_80pct = [float(within_80pct.min()), float(within_80pct.max())]
+    stability_range = [None, None]
+    stable = ph[ddg < 0.0]
+    if len(stable):
+        stability_range = [float(stable.min()), float(stable.max())]
+    return opt, range_80pct, stability_range
+
+
+def folding_profile_at(groups, ph, reference='neutral'):
+    """
+    Like `folding_profile`, but evaluated at each value of the array `ph`,
+    which does not need to be evenly spaced. The profile is an (n, 2) array.
+    """
+    pka, model_pka, _, ddg_neutral = group_arrays(groups)
+    ddg = folding_energies(pka, model_pka, ddg_neutral, ph, reference)
+    opt, range_80pct, stability_range = _folding_summary_numpy(ph, ddg)
+    return np.column_stack([ph, ddg]), opt, range_80pct, stability_range
+
+
+def folding_profile(groups, reference='neutral', grid=(0., 14., .1), engine='python'):
+    """
+    Folding free energy profile, plus optimum, 80% range and stability range,
+    as returned by `Molecular_container.getFoldingProfile`. With
+    ``engine='numpy'``, the profile is an (n, 2) array instead of a list.
+    """
+    if engine == 'numpy':
+        return folding_profile_at(groups, grid_points(grid), reference)
+    profile = [[ph, folding_energy(groups, ph, reference)] for ph in make_grid(*grid)]
+
+    opt = [None, 1e6]
+    for point in profile:
+        opt = min(opt, point, key=lambda v: v[1])
+
+    range_80pct = [None, None]
+    values_within_80pct = [p[0] for p in profile if p[1] < 0.8 * opt[1]]
+    if values_within_80pct:
+        range_80pct = [min(values_within_80pct), max(values_within_80pct)]
+
+    stability_range = [None, None]
+    stable_values = [p[0] for p in profile if p[1] < 0.0]
+    if stable_values:
+        stability_range = [min(stable_values), max(stable_values)]
+
+    return profile, opt, range_80pct, stability_range
+
+
+def adaptive_grid(groups, grid=(0., 14., 1.), reference='neutral',
+                  tolerance=ADAPTIVE_TOLERANCE, min_step=1e-3):
+    """
+    Non-uniform pH values that resolve the charge and folding free energy
+    curves of `groups` to within `tolerance`.
+
+    The search starts from the points of the coarse `grid`, plus the
+    titration midpoints (pKa and model pKa of every group) and the folded
+    and unfolded pI that fall inside it. Every interval whose midpoint
+    deviates from the straight line between its ends by more than
+    `tolerance` (in charge units or kcal/mol) is split in two, and so are
+    the intervals where the folding free energy crosses the thresholds of
+    the stability and 80% ranges, until no interval needs it or they are
+    narrower than `min_step`. Points thus concentrate where the curves
+    bend (around the pI, the titration midpoints and the stability
+    optimum) and at the ends of those ranges.
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted pH values.
+    """
+    start, stop = float(grid[0]), float(grid[1])
+    pka, model_pka, charge, ddg_neutral = group_arrays(groups)
+
+    def curves(ph):
+        return np.column_stack([charge_matrix(model_pka, charge, ph).sum(axis=1),
+                                charge_matrix(pka, charge, ph).sum(axis=1),
+                                folding_energies(pka, model_pka, ddg_neutral, ph, reference)])
+
+    seeds = np.concatenate([grid_points(grid), [start, stop], pka, model_pka,
+                            solve_isoelectric_points([groups], bracket=(start, stop))[0]])
+    ph = np.unique(seeds[(seeds >= start) & (seeds <= stop)])
+    values = curves(ph)
+    while len(ph) > 1:
+        wide = np.flatnonzero(np.diff(ph) > 2 * min_step)
+        middle = (ph[wide] + ph[wide + 1]) / 2
+        middle_values = curves(middle)
+        linear = (values[wide] + values[wide + 1]) / 2
+        split = (np.abs(middle_values - linear) > tolerance).any(axis=1)
+        for threshold in (0.0, 0.8 * values[:, 2].min()):  # stability and 80% ranges
+            below = values[:, 2] < threshold
+            split |= below[wide] != below[wide + 1]
+        if not split.any():
+            break
+        ph = np.concatenate([ph, middle[split]])
+        values = np.concatenate([values, middle_values[split]])
+        order = np.argsort(ph, kind='mergesort')
+        ph, values = ph[order], values[order]
+    return ph
+
+
+def ph_profiles(groups, grid=(0., 14., .1), reference='neutral', engine='numpy',
+                pi_solver='root', adaptive=False, tolerance=ADAPTIVE_TOLERANCE, pi=None):
+    """
+    All the pH-dependent entries of a `propka_run` results dict, including
+    the titration curves of every group on the points of the charge
+    profile (see `titration_curves`). The pI is
+    found by root finding with `solve_isoelectric_points`, or by refining
+    `grid` like PropKa does if `pi_solver` is ``'grid'``, unless the
+    (folded, unfolded) `pi` is given (see `batch_ph_profiles`).
+
+    If `adaptive`, `grid` is only the starting point of `adaptive_grid` and
+    the profiles are evaluated on the non-uniform pH values it returns,
+    always with the NumPy engine.
+    """
+    if pi is not None:
+        folded_pi, unfolded_pi = pi
+    elif pi_solver == 'root':
+        folded_pi, unfolded_pi = solve_isoelectric_points([groups])[0].tolist()
+    else:
+        folded_pi, unfolded_pi = isoelectric_points(groups, grid, engine=engine)
+    if adaptive:
+        ph = adaptive_grid(groups, grid, reference=reference, tolerance=tolerance)
+        charges = charge_profile_at(groups, ph)
+        profile, (pH_opt, dG_opt), (dG_min, dG_max), (pH_min, pH_max) = \
+            folding_profile_at(groups, ph, reference)
+    else:
+        charges = charge_profile(groups, grid, engine=engine)
+        profile, (pH_opt, dG_opt), (dG_min, dG_max), (pH_min, pH_max) = \
+            folding_profile(groups, reference=reference, grid=grid, engine=engine)
+    return {'charge_profile': charges,
+            'titration': titration_curves(groups, [point[0] for point in charges]),
+            'pi_folded': folded_pi,
+            'pi_unfolded': unfolded_pi,
+            'folding_profile': profile,
+            'pH_opt': pH_opt,
+            'dG_opt': dG_opt,
+            'dG_min': dG_min,
+            'dG_max': dG_max,
+            'pH_min': pH_min,
+            'pH_max': pH_max}
+
+
+def batch_ph_profiles(group_lists, pi_solver='root', **kwargs):
+    """
+    `ph_profiles` of several structures, with the pI of all of them found
+    in a single `solve_isoelectric_points` call.
+    """
+    if pi_solver != 'root' or not group_lists:
+        return [ph_profiles(groups, pi_solver=pi_solver, **kwargs) for groups in group_lists]
+    pis = solve_isoelectric_points(group_lists).tolist()
+    return [ph_profiles(groups, pi=pi, **kwargs) for (groups, pi) in zip(group_lists, pis)]
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Regression checks of the pH profiles in `profiles` against PropKa's own
+`getChargeProfile`, `getPI` and `getFoldingProfile`, with optional timings.
+
+They take a structure as a PDB path, stream, `AtomRecord` list or an
+already computed `PropkaContainer`, so they run without Chimera: the test
+suite runs them on bundled structures, and `benchmarks` on open models.
+"""
+
+from __future__ import print_function, division
+import timeit
+import numpy as np
+import propka.lib
+from .container import PropkaContainer
+from .profiles import (ADAPTIVE_TOLERANCE, snapshot_groups, adaptive_grid, charge_profile as
+                       _charge_profile, isoelectric_points as _isoelectric_points,
+                       solve_isoelectric_points, folding_profile as _folding_profile,
+                       folding_profile_at)
+
+
+def best_of(function, repeat):
+    """
+    Best wall time in seconds of `repeat` calls of `function`, or None if
+    `repeat` is 0.
+    """
+    if not repeat:
+        return None
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def _seconds(value):
+    return '    n/a ' if value is None else '{:8.3f}'.format(value)
+
+
+def averaged_container(source, options=('-q',)):
+    """
+    PropKa container of `source` with its pKa values computed and averaged,
+    plus a snapshot of its titratable groups. A `PropkaContainer` is assumed
+    to be computed already and is used as is.
+    """
+    if isinstance(source, PropkaContainer):
+        propka_mol = source
+    else:
+        args, _ = propka.lib.loadOptions(*options)
+        if isinstance(source, (str, type(u''))):
+            with open(source) as f:
+                propka_mol = PropkaContainer(f, args, name=source)
+        else:
+            propka_mol = PropkaContainer(source, args)
+        for conformation in propka_mol.conformations.values():
+            conformation.calculate_pka(propka_mol.version, propka_mol.options)
+        propka_mol.find_non_covalently_coupled_groups()
+        propka_mol.average_of_conformations()
+    return propka_mol, snapshot_groups(propka_mol.conformations['AVR'])
+
+
+def charge_profile(source, options=('-q',), grids=((0., 14., .1), (0., 14., .01)),
+                   repeat=3, name='molecule'):
+    """
+    Check that `profiles.charge_profile` reproduces PropKa's
+    `getChargeProfile` point by point with the Python and NumPy engines,
+    for each grid, and time them.
+
+    Returns
+    -------
+    list of dict
+        One entry per grid, with the largest absolute deviation of each
+        engine, whether the number of points matches and the best wall time
+        in seconds of each implementation.
+    """
+    propka_mol, groups = averaged_container(source, options)
+    print('{} ({} titratable groups)'.format(name, len(groups)))
+    report = []
+    for grid in grids:
+        expected = propka_mol.getChargeProfile(grid=list(grid))
+        entry = {'grid': grid}
+        for engine in ('python', 'numpy'):
+            computed = _charge_profile(groups, grid=grid, engine=engine)
+            entry[engine + '_deviation'] = max(abs(a - b) for (row_a, row_b) in
+                                               zip(expected, computed)
+                                               for (a, b) in zip(row_a, row_b))
+            entry[engine + '_points_match'] = len(expected) == len(computed)
+            entry[engine] = best_of(lambda: _charge_profile(groups, grid=grid, engine=engine),
+                                    repeat)
+        entry['propka'] = best_of(lambda: propka_mol.getChargeProfile(grid=list(grid)), repeat)
+        report.append(entry)
+        print('  grid {} propka {} s  python {} s  numpy {} s  max dev {:.1e} / {:.1e}'.format(
+            grid, _seconds(entry['propka']), _seconds(entry['python']),
+            _seconds(entry['numpy']), entry['python_deviation'], entry['numpy_deviation']))
+    return report
+
+
+def isoelectric_point(source, options=('-q',), grid=(0., 14., 1), repeat=3, name='molecule'):
+    """
+    Check `profiles.isoelectric_points` (Python and NumPy engines), which
+    must return PropKa's `getPI` values exactly, and
+    `profiles.solve_isoelectric_points`, whose roots are checked with
+    PropKa's own net charge at them, since `getPI` stops refining once the
+    charge is below 0.01. All of them are timed.
+
+    Returns
+    -------
+    dict
+        Folded and unfolded pI of each implementation, whether the grid
+        searches match PropKa, the largest PropKa net charge at the roots
+        and the best wall time in seconds of each implementation.
+    """
+    propka_mol, groups = averaged_container(source, options)
+    expected = tuple(propka_mol.getPI(grid=list(grid)))
+    computed = {'python': tuple(_isoelectric_points(groups, grid=grid)),
+                'numpy': tuple(_isoelectric_points(groups, grid=grid, engine='numpy')),
+                'root': tuple(solve_isoelectric_points([groups])[0].tolist())}
+    conformation, parameters = propka_mol.conformations['AVR'], propka_mol.version.parameters
+    folded_pi, unfolded_pi = computed['root']
+    root_charge = max(abs(conformation.calculate_charge(parameters, pH=folded_pi)[1]),
+                      abs(conformation.calculate_charge(parameters, pH=unfolded_pi)[0]))
+    report = {'propka_pi': expected,
+              'grid_matches': computed['python'] == expected == computed['numpy'],
+              'root_charge': root_charge,
+              'propka': best_of(lambda: propka_mol.getPI(grid=list(grid)), repeat),
+              'python': best_of(lambda: _isoelectric_points(groups, grid=grid), repeat),
+              'numpy': best_of(lambda: _isoelectric_points(groups, grid=grid, engine='numpy'),
+                               repeat),
+              'root': best_of(lambda: solve_isoelectric_points([groups]), repeat)}
+    for engine, value in computed.items():
+        report[engine + '_pi'] = value
+    print('{} ({} titratable groups): pI folded {:.4f}, unfolded {:.4f}'.format(
+        name, len(groups), *expected))
+    print('  propka {} s  python {} s  numpy {} s  root {} s  grid {}  '
+          'charge at roots {:.1e}'.format(
+              _seconds(report['propka']), _seconds(report['python']),
+              _seconds(report['numpy']), _seconds(report['root']),
+              'ok' if report['grid_matches'] else 'DIFFERS', root_charge))
+    return report
+
+
+def _same_folding_summary(expected, computed, tolerance=1e-9):
+    """
+    Whether two `getFoldingProfile`-like results share the same optimum pH,
+    80% and stability ranges, and an optimum free energy within `tolerance`
+    (summation order differs, so the last digits may not).
+    """
+    (ph_a, dg_a), ranges_a = expected[1], list(expected[2:])
+    (ph_b, dg_b), ranges_b = computed[1], list(computed[2:])
+    return ph_a == ph_b and abs(dg_a - dg_b) <= tolerance and ranges_a == ranges_b
+
+
+def _range_deviation(expected, computed):
+    """
+    Largest distance between the ends of matching pH ranges, or infinity if
+    one of them is empty and the other is not.
+    """
+    deviation = 0.0
+    for range_a, range_b in zip(expected, computed):
+        for a, b in zip(range_a, range_b):
+            if (a is None) != (b is None):
+                return float('inf')
+            if a is not None:
+                deviation = max(deviation, abs(a - b))
+    return deviation
+
+
+def folding_profile(source, options=('-q',), grids=((0., 14., .1), (0., 14., .01)),
+                    references=('neutral', 'low-pH'), repeat=3, name='molecule',
+                    tolerance=ADAPTIVE_TOLERANCE, fine_step=.001):
+    """
+    Check `profiles.folding_profile` against PropKa's `getFoldingProfile`
+    for each grid and reference state, and time both engines. The NumPy
+    engine must reproduce PropKa's profile and summary values.
+
+    For each reference, the profile on the `adaptive_grid` resolved to
+    `tolerance` is also compared with PropKa's profile on a uniform grid of
+    `fine_step`: its linear interpolation, optimum and range ends should
+    deviate by at most about `tolerance` (in kcal/mol) and `fine_step` (in
+    pH units).
+
+    Returns
+    -------
+    list of dict
+        One entry per grid and reference, with the largest absolute
+        deviation of the NumPy profile, whether the optimum and ranges are
+        identical and the best wall time in seconds of each implementation,
+        followed by one ``grid='adaptive'`` entry per reference with its
+        number of points and the deviations of its profile (``deviation``),
+        optimum free energy (``dG_opt_deviation``) and pH (``pH_opt_deviation``,
+        plus ``pH_opt_excess``, PropKa's free energy at that pH above its own
+        optimum) and range ends (``range_deviation``).
+    """
+    propka_mol, groups = averaged_container(source, options)
+    print('{} ({} titratable groups)'.format(name, len(groups)))
+    report = []
+    for grid in grids:
+        for reference in references:
+            expected = propka_mol.getFoldingProfile(reference=reference, grid=list(grid))
+            computed = _folding_profile(groups, reference=reference, grid=grid, engine='numpy')
+            deviation = max(abs(a[1] - b[1]) for (a, b) in zip(expected[0], computed[0]))
+            entry = {'grid': grid, 'reference': reference,
+                     'deviation': deviation,
+                     'summary_matches': _same_folding_summary(expected, computed),
+                     'propka': best_of(lambda: propka_mol.getFoldingProfile(
+                         reference=reference, grid=list(grid)), repeat),
+                     'python': best_of(lambda: _folding_profile(
+                         groups, reference=reference, grid=grid), repeat),
+                     'numpy': best_of(lambda: _folding_profile(
+                         groups, reference=reference, grid=grid, engine='numpy'), repeat)}
+            report.append(entry)
+            print('  grid {} {:<8} propka {} s  python {} s  numpy {} s  max dev {:.1e}  '
+                  'summary {}'.format(grid, reference, _seconds(entry['propka']),
+                                      _seconds(entry['python']), _seconds(entry['numpy']),
+                                      deviation,
+                                      'ok' if entry['summary_matches'] else 'DIFFERS'))
+    fine_grid = (0., 14., fine_step)
+    for reference in references:
+        expected = propka_mol.getFoldingProfile(reference=reference, grid=list(fine_grid))
+        fine = np.array(expected[0])
+        ph = adaptive_grid(groups, reference=reference, tolerance=tolerance)
+        computed = folding_profile_at(groups, ph, reference)
+        entry = {'grid': 'adaptive', 'reference': reference, 'points': len(ph),
+                 'deviation': float(np.abs(np.interp(fine[:, 0], ph, computed[0][:, 1])
+                                           - fine[:, 1]).max()),
+                 'dG_opt_deviation': abs(computed[1][1] - expected[1][1]),
+                 'pH_opt_deviation': abs(computed[1][0] - expected[1][0]),
+                 # the optimum can be flat: how much worse PropKa finds the computed one
+                 'pH_opt_excess': float(np.interp(computed[1][0], fine[:, 0], fine[:, 1])
+                                        - expected[1][1]),
+                 'range_deviation': _range_deviation(expected[2:], computed[2:]),
+                 'numpy': best_of(lambda: folding_profile_at(
+                     groups, adaptive_grid(groups, reference=reference, tolerance=tolerance),
+                     reference), repeat)}
+        report.append(entry)
+        print('  adaptive {:<8} {} points  numpy {} s  max dev {:.1e}  dG_opt dev {:.1e}  '
+              'pH_opt dev {:.1e}  ranges dev {:.1e}'.format(
+                  reference, entry['points'], _seconds(entry['numpy']), entry['deviation'],
+                  entry['dG_opt_deviation'], entry['pH_opt_deviation'],
+                  entry['range_deviation']))
+    return report
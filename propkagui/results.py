@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Compact, array-backed container for the results of a PropKa run.
+
+`propka_run` used to return per-residue values as dicts keyed by
+``(residue_type, residue_number, chain)`` tuples, one dict per quantity.
+`PropkaResults` keeps them in a single NumPy structured array instead (one
+row per group, residue types stored as small integer codes) with a lazily
+built residue index, and the pH profiles as float arrays. It still behaves
+like the old results dict: ``results['residues_pka']`` is a read-only
+mapping view over the arrays, and any other entry is stored as is, so
+existing consumers keep working while new ones can use the arrays directly.
+"""
+
+from __future__ import print_function, division
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:  # Python 2
+    from collections import Mapping, MutableMapping
+import numpy as np
+from .profiles import charge_matrix
+from .store import approximate_size
+
+
+RESIDUE_DTYPE = np.dtype([('type_code', '<u2'), ('number', '<i4'), ('chain', 'S4'),
+                          ('pka', '<f8'), ('charge', '<f8')])
+RESIDUE_FIELDS = {'residues_pka': 'pka', 'residues_charge': 'charge'}
+ARRAY_FIELDS = ('charge_profile', 'folding_profile')
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class ResidueValues(Mapping):
+
+    """
+    Read-only ``{(residue_type, number, chain): value}`` view of one
+    column of a `PropkaResults`.
+    """
+
+    def __init__(self, results, field):
+        self._results = results
+        self.field = field
+
+    @property
+    def array(self):
+        return self._results.residues[self.field]
+
+    def __getitem__(self, residue):
+        return float(self.array[self._results.index(residue)])
+
+    def __iter__(self):
+        return iter(self._results.keys_list())
+
+    def __len__(self):
+        return len(self._results.residues)
+
+    def items(self):
+        return list(zip(self._results.keys_list(), self.array.tolist()))
+
+    def values(self):
+        return self.array.tolist()
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+
+class PropkaResults(MutableMapping):
+
+    """
+    Parameters
+    ----------
+    residues_pka, residues_charge : dict, optional
+        Per-residue values keyed by (residue_type, number, chain). Keys
+        missing from `residues_charge` get a NaN charge.
+    **entries
+        Any other result entry (pH profiles, scalars, groups...). Profiles
+        are stored as float arrays.
+
+    Attributes
+    ----------
+    residues : numpy.ndarray
+        Structured array with ``type_code``, ``number``, ``chain``, ``pka``
+        and ``charge`` fields, one row per residue, sorted by residue key.
+    residue_types : numpy.ndarray
+        Residue type names, indexed by ``type_code``.
+    """
+
+    def __init__(self, residues_pka=None, residues_charge=None, **entries):
+        self._entries = {}
+        self.set_residues(residues_pka or {}, residues_charge or {})
+        for key, value in entries.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, results):
+        """
+        Build from a results dict (or another mapping), as returned by
+        older versions of `propka_run` or stored in old caches.
+        """
+        if isinstance(results, cls):
+            return results
+        return cls(**dict(results))
+
+    def set_residues(self, residues_pka, residues_charge):
+        keys = sorted(residues_pka)
+        types = sorted(set(key[0] for key in keys))
+        codes = dict((name, i) for (i, name) in enumerate(types))
+        self.residue_types = np.array(types, dtype='S6')
+        self.residues = np.array(
+            [(codes[t], n, c.encode('utf-8'), residues_pka[(t, n, c)],
+              residues_charge.get((t, n, c), np.nan)) for (t, n, c) in keys],
+            dtype=RESIDUE_DTYPE)
+        self._index = None
+
+    def keys_list(self):
+        """
+        Residue keys, in row order, rebuilt from the arrays on each call.
+        """
+        types = [_text(t) for t in self.residue_types.tolist()]
+        return [(types[code], number, _text(chain))
+                for (code, number, chain) in zip(self.residues['type_code'].tolist(),
+                                                 self.residues['number'].tolist(),
+                                                 self.residues['chain'].tolist())]
+
+    def index(self, residue):
+        """
+        Row of `residue`, a (residue_type, number, chain) key. The lookup
+        table is built on first use.
+        """
+        if self._index is None:
+            self._index = dict((key, i) for (i, key) in enumerate(self.keys_list()))
+        return self._index[residue]
+
+    def type_names(self):
+        """
+        Residue type name of each row, as an array of strings.
+        """
+        return np.array([_text(t) for t in self.residue_types.tolist()],
+                        dtype=object)[self.residues['type_code']]
+
+    def charges_at(self, ph):
+        """
+        Fractional charge of each row at `ph`, from its pKa and formal charge
+        (Henderson-Hasselbalch), evaluated for all residues at once. Rows
+        without a charge get zero.
+        """
+        formal = np.nan_to_num(self.residues['charge'])
+        return charge_matrix(self.residues['pka'], formal, [ph])[0]
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory use, for `store.ResultStore` budgets.
+        """
+        return (self.residues.nbytes + self.residue_types.nbytes
+                + approximate_size(self._entries))
+
+    # Mapping interface
+    def __getitem__(self, key):
+        field = RESIDUE_FIELDS.get(key)
+        if field is not None:
+            return ResidueValues(self, field)
+        return self._entries[key]
+
+    def __setitem__(self, key, value):
+        if key == 'residues_pka':
+            self.set_residues(value, dict(self['residues_charge']))
+        elif key == 'residues_charge':
+            self.set_residues(dict(self['residues_pka']), value)
+        elif key in ARRAY_FIELDS:
+            self._entries[key] = np.asarray(value, dtype=float)
+        else:
+            self._entries[key] = value
+
+    def __delitem__(self, key):
+        if key in RESIDUE_FIELDS:
+            raise KeyError('{} cannot be removed'.format(key))
+        del self._entries[key]
+
+    def __iter__(self):
+        for key in sorted(RESIDUE_FIELDS):
+            yield key
+        for key in self._entries:
+            yield key
+
+    def __len__(self):
+        return len(RESIDUE_FIELDS) + len(self._entries)
+
+    def __contains__(self, key):
+        return key in RESIDUE_FIELDS or key in self._entries
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_index'] = None  # cheap to rebuild, not worth pickling
+        return state
+
+    def __repr__(self):
+        return '<{} with {} residues>'.format(type(self).__name__, len(self.residues))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Reuse of per-group desolvation terms between similar structures.
+
+Consecutive frames of a trajectory often leave the surroundings of most
+titratable groups nearly unchanged, yet PropKa recomputes the desolvation
+of every group by looping over all the heavy atoms of the structure, which
+is one of the most expensive stages of a run. `EnvironmentCache` remembers,
+for each group, the environment its desolvation terms were computed in
+(heavy atoms of other residues within the desolvation cutoff, with their
+coordinates relative to the group). When the same group comes up again
+with the same neighbour atoms, none of them moved by more than a tolerance,
+the stored terms are restored instead of recomputed.
+
+With a tolerance of zero only exactly equal environments are reused;
+larger tolerances trade accuracy for reuse.
+"""
+
+from __future__ import print_function, division
+from collections import OrderedDict
+import numpy as np
+import propka.molecular_container  # import first, to avoid PropKa's circular imports
+import propka.calculations
+
+
+class EnvironmentCache(object):
+
+    """
+    Parameters
+    ----------
+    tolerance : float
+        Largest displacement, in angstroms, of any neighbour atom (relative
+        to the group) for an environment to count as unchanged.
+    max_entries : int, optional
+        Groups to remember, least recently used are dropped first.
+    """
+
+    def __init__(self, tolerance=0.1, max_entries=100000):
+        self.tolerance = tolerance
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    @property
+    def reuse_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'groups': self.hits + self.misses, 'reused': self.hits}
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    def install(self, version):
+        """
+        Route the desolvation calculations of a PropKa `version` object
+        through this cache. Only the default radial volume model is supported;
+        other models are left untouched.
+
+        Returns
+        -------
+        bool
+            Whether the cache was installed.
+        """
+        if version.desolvation_model is not propka.calculations.radial_volume_desolvation:
+            return False
+        environments = {}
+
+        def desolvation(parameters, group):
+            conformation = group.atom.conformation_container
+            environment = environments.get(id(conformation))
+            if environment is None:
+                environment = environments[id(conformation)] = _Environment(
+                    conformation, parameters)
+            key, atoms, relative = environment.neighbourhood(group)
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] == atoms and (
+                    not len(relative) or np.abs(relative - entry[1]).max() <= self.tolerance):
+                self.hits += 1
+                group.Nmass, group.buried, group.Emass = entry[2]
+            else:
+                # Keep the environment the terms were computed in, so small
+                # displacements cannot add up over many frames
+                self.misses += 1
+                propka.calculations.radial_volume_desolvation(parameters, group)
+                entry = atoms, relative, (group.Nmass, group.buried, group.Emass)
+            self._entries[key] = entry  # most recently used go last
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        version.desolvation_model = desolvation
+        return True
+
+
+class _Environment(object):
+
+    """
+    Heavy atom coordinates and identities of a conformation, as arrays, to
+    extract the neighbourhood of its groups quickly.
+    """
+
+    def __init__(self, conformation, parameters):
+        atoms = conformation.get_non_hydrogen_atoms()
+        self.xyz = np.array([(a.x, a.y, a.z) for a in atoms], dtype=float)
+        self.residues = [(a.resNumb, a.chainID) for a in atoms]
+        # Identities decide the desolvation volumes, so equal identities and
+        # positions mean equal terms
+        self.atoms = [(a.chainID, a.resNumb, a.name, a.element) for a in atoms]
+        self.cutoff2 = max(parameters.desolv_cutoff_squared, parameters.buried_cutoff_squared)
+        self.signature = tuple(getattr(parameters, name, None) for name in (
+            'desolv_cutoff', 'buried_cutoff', 'desolvationPrefactor', 'desolvationAllowance',
+            'desolvationSurfaceScalingFactor', 'Nmin', 'Nmax'))
+        self._residue_masks = {}
+
+    def _other_residues(self, residue):
+        mask = self._residue_masks.get(residue)
+        if mask is None:
+            mask = self._residue_masks[residue] = np.array(
+                [r != residue for r in self.residues], dtype=bool)
+        return mask
+
+    def neighbourhood(self, group):
+        """
+        Key identifying `group` across structures, plus the identities and
+        relative coordinates of the heavy atoms of other residues within
+        the desolvation cutoff.
+        """
+        atom = group.atom
+        relative = self.xyz - (group.x, group.y, group.z)
+        mask = self._other_residues((atom.resNumb, atom.chainID))
+        mask = mask & ((relative ** 2).sum(axis=1) < self.cutoff2)
+        key = (self.signature, group.residue_type, group.charge,
+               atom.chainID, atom.resNumb, atom.name)
+        return key, [self.atoms[i] for i in np.flatnonzero(mask).tolist()], relative[mask]
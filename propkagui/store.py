@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+In-memory store for PropKa results, keyed by molecule.
+
+Molecules are referenced weakly, so closing a model does not keep it (nor
+its results) alive, and the store is bounded both in number of entries
+and in approximate memory use, evicting least recently used entries first.
+"""
+
+from __future__ import print_function, division
+import mmap
+import sys
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+
+def is_mapped(array):
+    """
+    Whether the data of `array` lives in a memory-mapped file (e.g. columns
+    opened by `columnar.ColumnarResults`), so it is paged in on demand.
+    """
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def approximate_size(obj, _seen=None):
+    """
+    Rough recursive `sys.getsizeof` for the containers PropKa results use.
+    Memory-mapped arrays are not counted, since they do not use memory
+    until (and only while) they are read.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approximate_size(k, _seen) + approximate_size(v, _seen)
+                    for (k, v) in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, _seen) for item in obj)
+    elif hasattr(obj, 'nbytes') and not is_mapped(obj):  # numpy arrays
+        size += obj.nbytes
+    return size
+
+
+class ResultStore(object):
+
+    """
+    Bounded, weak-keyed LRU mapping of molecules to their results.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        Maximum number of molecules to keep results for.
+    max_size : int, optional
+        Approximate memory budget in bytes for all the stored results.
+    """
+
+    def __init__(self, max_entries=32, max_size=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._entries = OrderedDict()  # id(molecule) -> (ref, results, size)
+        self._size = 0
+
+    def _ref(self, molecule):
+        key = id(molecule)
+        try:
+            return weakref.ref(molecule, lambda _, key=key: self._discard_key(key))
+        except TypeError:  # object does not support weak references
+            return lambda: molecule
+
+    def __setitem__(self, molecule, results):
+        key = id(molecule)
+        self._discard_key(key)
+        size = approximate_size(results)
+        self._entries[key] = (self._ref(molecule), results, size)
+        self._size += size
+        self._evict()
+
+    def __getitem__(self, molecule):
+        key = id(molecule)
+        try:
+            ref, results, size = self._entries[key]
+        except KeyError:
+            raise KeyError(molecule)
+        if ref() is not molecule:  # stale entry whose id got reused
+            self._discard_key(key)
+            raise KeyError(molecule)
+        # mark as most recently used
+        del self._entries[key]
+        self._entries[key] = ref, results, size
+        return results
+
+    def get(self, molecule, default=None):
+        try:
+            return self[molecule]
+        except KeyError:
+            return default
+
+    def __contains__(self, molecule):
+        entry = self._entries.get(id(molecule))
+        return entry is not None and entry[0]() is molecule
+
+    def __delitem__(self, molecule):
+        if molecule not in self:
+            raise KeyError(molecule)
+        self._discard_key(id(molecule))
+
+    def discard(self, molecule):
+        self._discard_key(id(molecule))
+
+    def _discard_key(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        items = []
+        for ref, results, _ in list(self._entries.values()):
+            molecule = ref()
+            if molecule is not None:
+                items.append((molecule, results))
+        return items
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def update_sizes(self):
+        """
+        Measure every entry again, after its results were modified in place,
+        and evict entries if the store no longer fits in its budget.
+        """
+        for key, (ref, results, _) in list(self._entries.items()):
+            self._entries[key] = ref, results, approximate_size(results)
+        self._size = sum(entry[2] for entry in self._entries.values())
+        self._evict()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self._size > self.max_size):
+            if len(self._entries) == 1:  # always keep the latest result
+                break
+            key = next(iter(self._entries))
+            self._discard_key(key)
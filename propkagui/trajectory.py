@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-frame PropKa results of a trajectory, as frame x residue arrays.
+
+Each frame is an independent `propka_run` job. Once they are done, their
+results are merged into a single results dict that the results dialog can
+display like any other (ensemble averages per residue, pH profiles of the
+averaged groups), plus a ``'trajectory'`` entry with the full time series.
+
+For very long trajectories, `FrameStatistics` aggregates frames as they
+complete instead (running mean, variance, extrema and histograms per
+residue), so memory use does not grow with the number of frames.
+"""
+
+from __future__ import print_function, division
+import warnings
+import numpy as np
+from .profiles import ph_profiles
+from .results import PropkaResults
+
+
+def select_frames(keys, start=1, stop=None, stride=1):
+    """
+    Sorted frame keys between `start` and `stop` (both included, no upper
+    bound if `stop` is None or not positive), every `stride` frames.
+    """
+    keys = sorted(keys)
+    if stop is None or stop <= 0:
+        stop = keys[-1] if keys else 0
+    return [k for k in keys if start <= k <= stop][::max(1, stride)]
+
+
+def average_groups(groups_per_frame):
+    """
+    Ensemble-averaged `TitratableGroup` list: pKa and neutral reference
+    free energy are averaged over the frames each group appears in.
+    """
+    collected = {}
+    for groups in groups_per_frame:
+        for group in groups:
+            key = group.residue_type, group.number, group.chain
+            collected.setdefault(key, []).append(group)
+    averaged = []
+    for key in sorted(collected):
+        groups = collected[key]
+        averaged.append(groups[0]._replace(
+            pka=sum(g.pka for g in groups) / len(groups),
+            ddg_neutral=sum(g.ddg_neutral for g in groups) / len(groups)))
+    return averaged
+
+
+def combine_frames(frames, results, grid=(0., 14., .1), reference='neutral', adaptive=False):
+    """
+    Merge the `propka_run` results of each frame into a single results dict.
+
+    Parameters
+    ----------
+    frames : list
+        Frame identifiers, in the same order as `results`.
+    results : list of dict
+        Results of each frame.
+
+    Returns
+    -------
+    dict
+        ``residues_pka`` and ``residues_charge`` hold the mean over frames,
+        ``residues_pka_std`` the standard deviation of the pKa, and the pH
+        profiles are computed from the averaged groups. The ``trajectory``
+        entry holds ``frames``, ``residues`` (keys in column order) and the
+        ``pka`` and ``charge`` frame x residue arrays (NaN where a residue
+        is missing from a frame). If frames report environment reuse, their
+        counts are added up in ``reuse``.
+    """
+    residues = sorted(set(key for r in results for key in r['residues_pka']))
+    columns = dict((key, j) for (j, key) in enumerate(residues))
+    pka = np.full((len(results), len(residues)), np.nan)
+    charge = np.full((len(results), len(residues)), np.nan)
+    for i, r in enumerate(results):
+        for key, value in r['residues_pka'].items():
+            pka[i, columns[key]] = value
+        for key, value in r['residues_charge'].items():
+            charge[i, columns[key]] = value
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean_pka, std_pka = np.nanmean(pka, axis=0), np.nanstd(pka, axis=0)
+        mean_charge = np.nanmean(charge, axis=0)
+
+    groups = average_groups([r.get('groups', ()) for r in results])
+    combined = {'residues_pka': dict(zip(residues, mean_pka.tolist())),
+                'residues_charge': dict(zip(residues, mean_charge.tolist())),
+                'residues_pka_std': dict(zip(residues, std_pka.tolist())),
+                'groups': groups,
+                'trajectory': {'frames': np.asarray(frames),
+                               'residues': residues,
+                               'pka': pka,
+                               'charge': charge}}
+    reuse = [r['reuse'] for r in results if 'reuse' in r]
+    if reuse:
+        combined['reuse'] = {'groups': sum(r['groups'] for r in reuse),
+                             'reused': sum(r['reused'] for r in reuse)}
+    combined.update(ph_profiles(groups, grid=grid, reference=reference, adaptive=adaptive))
+    return PropkaResults.from_dict(combined)
+
+
+class RunningStatistics(object):
+
+    """
+    Per-column running count, mean, variance (Welford's algorithm), minimum,
+    maximum and fixed-bin histogram. Columns are added on demand.
+
+    Parameters
+    ----------
+    bins : sequence of float
+        Histogram bin edges. Values out of range go to the outermost bins.
+    """
+
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=float)
+        self.count = np.zeros(0, dtype=int)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+        self.histogram = np.zeros((0, len(self.bins) - 1), dtype=int)
+
+    def __len__(self):
+        return len(self.count)
+
+    def _grow(self, size):
+        extra = size - len(self.count)
+        if extra <= 0:
+            return
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=int)])
+        self.mean = np.concatenate([self.mean, np.zeros(extra)])
+        self.m2 = np.concatenate([self.m2, np.zeros(extra)])
+        self.min = np.concatenate([self.min, np.full(extra, np.inf)])
+        self.max = np.concatenate([self.max, np.full(extra, -np.inf)])
+        self.histogram = np.concatenate(
+            [self.histogram, np.zeros((extra, self.histogram.shape[1]), dtype=int)])
+
+    def add(self, columns, values):
+        """
+        Account for one new observation of each of the given (unique) `columns`.
+        """
+        columns = np.asarray(columns, dtype=int)
+        values = np.asarray(values, dtype=float)
+        if not len(columns):
+            return
+        self._grow(columns.max() + 1)
+        self.count[columns] += 1
+        delta = values - self.mean[columns]
+        self.mean[columns] += delta / self.count[columns]
+        self.m2[columns] += delta * (values - self.mean[columns])
+        self.min[columns] = np.minimum(self.min[columns], values)
+        self.max[columns] = np.maximum(self.max[columns], values)
+        bins = np.clip(np.searchsorted(self.bins, values, side='right') - 1,
+                       0, self.histogram.shape[1] - 1)
+        self.histogram[columns, bins] += 1
+
+    @property
+    def variance(self):
+        """
+        Population variance, like `numpy.var` with the default ``ddof=0``.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.m2 / self.count, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'std': self.std,
+                'min': self.min, 'max': self.max,
+                'histogram': self.histogram, 'bins': self.bins}
+
+
+class FrameStatistics(object):
+
+    """
+    Streaming counterpart of `combine_frames`: add the results of each frame
+    as soon as they are available and drop them, then get a single results
+    dict with `results`.
+
+    Parameters
+    ----------
+    pka_bins, charge_bins : sequence of float, optional
+        Histogram bin edges for pKa values and charges.
+    """
+
+    def __init__(self, pka_bins=np.arange(0., 14.25, .25), charge_bins=np.linspace(-1., 1., 21)):
+        self.residues = []
+        self._columns = {}
+        self.pka = RunningStatistics(pka_bins)
+        self.charge = RunningStatistics(charge_bins)
+        self.frames = 0
+        self._groups = {}  # key -> [template group, count, pka sum, ddg_neutral sum]
+        self._reuse = None
+
+    def _column(self, residue):
+        column = self._columns.get(residue)
+        if column is None:
+            column = self._columns[residue] = len(self.residues)
+            self.residues.append(residue)
+        return column
+
+    def add(self, result):
+        self.frames += 1
+        for name, stats in (('residues_pka', self.pka), ('residues_charge', self.charge)):
+            values = result[name]
+            stats.add([self._column(key) for key in values], list(values.values()))
+        for group in result.get('groups', ()):
+            key = group.residue_type, group.number, group.chain
+            entry = self._groups.setdefault(key, [group, 0, 0.0, 0.0])
+            entry[1] += 1
+            entry[2] += group.pka
+            entry[3] += group.ddg_neutral
+        if 'reuse' in result:
+            if self._reuse is None:
+                self._reuse = {'groups': 0, 'reused': 0}
+            self._reuse['groups'] += result['reuse']['groups']
+            self._reuse['reused'] += result['reuse']['reused']
+
+    def results(self, grid=(0., 14., .1), reference='neutral', adaptive=False):
+        """
+        Results dict with the same per-residue and pH profile entries as
+        `combine_frames`, but with a ``statistics`` entry instead of the
+        frame x residue arrays: ``residues`` (keys in column order), and
+        ``frames``, plus ``pka`` and ``charge`` dicts of per-residue arrays
+        (``count``, ``mean``, ``std``, ``min``, ``max``, ``histogram`` and
+        its ``bins``).
+        """
+        groups = [template._replace(pka=pka / count, ddg_neutral=ddg / count)
+                  for (_, (template, count, pka, ddg)) in sorted(self._groups.items())]
+        results = {'residues_pka': dict(zip(self.residues, self.pka.mean.tolist())),
+                   'residues_charge': dict(zip(self.residues, self.charge.mean.tolist())),
+                   'residues_pka_std': dict(zip(self.residues, self.pka.std.tolist())),
+                   'groups': groups,
+                   'statistics': {'frames': self.frames,
+                                  'residues': list(self.residues),
+                                  'pka': self.pka.as_dict(),
+                                  'charge': self.charge.as_dict()}}
+        if self._reuse is not None:
+            results['reuse'] = dict(self._reuse)
+        results.update(ph_profiles(groups, grid=grid, reference=reference, adaptive=adaptive))
+        return PropkaResults.from_dict(results)
@@ -40,6 +40,10 @@ setup(
         'Operating System :: OS Independent',
         'Topic :: Scientific/Engineering :: Chemistry',
     ],
-    install_requires=['propka'],
+    install_requires=['propka', 'numpy'],
+    entry_points={
+        'console_scripts': ['tangram_propka = propkagui.cli:main',
+                            'tangram_propka_queue = propkagui.dirqueue:main'],
+    },
     dependency_links=['https://github.com/jensengroup/propka-3.1/archive/master.zip#egg=propka-3.1'],
 )
@@ -0,0 +1,40 @@
+# encoding: utf-8
+
+from __future__ import print_function, division
+import os
+import pytest
+from propkagui.container import AtomRecord
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def read_records(path):
+    """
+    Minimal PDB reader returning the first model as `AtomRecord` tuples,
+    standing in for `Controller.atom_records` outside Chimera.
+    """
+    records = []
+    with open(path) as f:
+        for line in f:
+            record = line[:6].strip()
+            if record == 'ENDMDL':
+                break
+            if record not in ('ATOM', 'HETATM') or line[16] not in ' A':
+                continue
+            name = line[12:16].strip()
+            records.append(AtomRecord(record, int(line[6:11]), name, line[17:20].strip(),
+                                      line[21], int(line[22:26]), line[26], ' ',
+                                      float(line[30:38]), float(line[38:46]),
+                                      float(line[46:54]), 1.0, 0.0,
+                                      line[76:78].strip() or name[0]))
+    return records
+
+
+@pytest.fixture(scope='session')
+def pdb_path():
+    return os.path.join(DATA, '5vav_cyclic_peptide.pdb')
+
+
+@pytest.fixture(scope='session')
+def records(pdb_path):
+    return read_records(pdb_path)
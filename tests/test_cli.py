@@ -0,0 +1,47 @@
+# encoding: utf-8
+
+from __future__ import print_function, division
+import json
+import os
+import shutil
+from propkagui import cli
+from propkagui.columnar import jsonl_records
+from propkagui.manifest import Manifest, file_digest
+from .conftest import DATA
+
+INPUTS = ('5vav_cyclic_peptide.pdb', 'cterm_hid.pdb')
+
+
+def _run(tmpdir, *extra):
+    inputs = [os.path.join(str(tmpdir), name) for name in INPUTS]
+    return cli.main(inputs + ['-j', '1', '-o', str(tmpdir.join('out.jsonl'))] + list(extra))
+
+
+def _lines(path):
+    with open(path) as f:
+        return f.read().splitlines(True)
+
+
+def test_resume_after_crash_mid_write(tmpdir):
+    for name in INPUTS:
+        shutil.copy(os.path.join(DATA, name), str(tmpdir))
+    assert _run(tmpdir) == 0
+    output, manifest = str(tmpdir.join('out.jsonl')), str(tmpdir.join('out.jsonl.manifest'))
+
+    # Crash while writing the last record, before it was journaled
+    lines = _lines(output)
+    with open(output, 'w') as f:
+        f.writelines(lines[:-1] + [lines[-1][:len(lines[-1]) // 2]])
+    lines = _lines(manifest)
+    with open(manifest, 'w') as f:
+        f.writelines(lines[:-1] + [lines[-1][:10]])
+
+    assert _run(tmpdir) == 0
+    records = [json.loads(line) for line in _lines(output)]
+    assert sorted(os.path.basename(r['input']) for r in records) == sorted(INPUTS)
+    assert sorted(os.path.basename(name) for (name, rows) in jsonl_records(output)
+                  if rows is not None) == sorted(INPUTS)
+    journal = Manifest(manifest)
+    for name in INPUTS:
+        path = str(tmpdir.join(name))
+        assert journal.is_done(path, file_digest(path), ['-q'])
@@ -0,0 +1,56 @@
+# encoding: utf-8
+
+from __future__ import print_function, division
+import os
+from propkagui.dirqueue import DirectoryQueue
+
+
+def _queue(tmpdir, jobs=20, **kwargs):
+    queue = DirectoryQueue(str(tmpdir.join('queue')), **kwargs)
+    queue.submit([str(tmpdir.join('{}.pdb'.format(i))) for i in range(jobs)], ['-q'])
+    return queue
+
+
+def test_claims_cover_every_job_once(tmpdir):
+    queue = _queue(tmpdir)
+    workers = [DirectoryQueue(queue.root) for _ in range(3)]
+    claimed = []
+    while True:
+        jobs = [w.claim('w{}'.format(i)) for (i, w) in enumerate(workers)]
+        jobs = [job for job in jobs if job is not None]
+        if not jobs:
+            break
+        claimed.extend(job['id'] for job in jobs)
+    assert len(claimed) == len(set(claimed)) == 20
+    assert queue.status()['claimed'] == 20
+
+
+def test_claims_reuse_one_listing(tmpdir, monkeypatch):
+    queue = _queue(tmpdir)
+    listings = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda path: listings.append(path) or listdir(path))
+    while queue.claim('worker') is not None:
+        pass
+    assert len(listings) == 2  # the initial listing, plus the one finding it empty
+
+
+def test_workers_listing_together_try_different_jobs(tmpdir):
+    queue = _queue(tmpdir, jobs=50)
+    workers = [DirectoryQueue(queue.root) for _ in range(10)]
+    for worker in workers:
+        worker._list_pending()
+    # With a sorted listing, all of them would race for the same first job
+    assert len(set(worker._listing[-1] for worker in workers)) > 1
+
+
+def test_abandoned_jobs_fail_after_max_attempts(tmpdir):
+    queue = _queue(tmpdir, jobs=1, max_attempts=2)
+    job = queue.claim('dead')  # never beats
+    assert queue.requeue_stale('live') == [job['id']]
+    job = queue.claim('dead')
+    assert job['attempts'] == 1
+    assert queue.requeue_stale('live') == []
+    assert queue.status() == {'pending': 0, 'claimed': 0, 'done': 1, 'workers': 0}
+    record, = queue.results()
+    assert record['id'] == job['id'] and 'Abandoned' in record['error']
@@ -0,0 +1,43 @@
+# encoding: utf-8
+
+from __future__ import print_function, division
+import os
+import pytest
+from propkagui import regression
+from propkagui.profiles import ADAPTIVE_TOLERANCE
+from .conftest import DATA
+
+STRUCTURES = ('5vav_cyclic_peptide.pdb', 'cterm_hid.pdb')
+
+
+@pytest.fixture(scope='module', params=STRUCTURES)
+def container(request):
+    return regression.averaged_container(os.path.join(DATA, request.param))[0]
+
+
+def test_charge_profile_matches_propka(container):
+    for entry in regression.charge_profile(container, repeat=0):
+        for engine in ('python', 'numpy'):
+            assert entry[engine + '_points_match']
+            assert entry[engine + '_deviation'] < 1e-9
+
+
+def test_isoelectric_points_match_propka(pdb_path):
+    report = regression.isoelectric_point(pdb_path, repeat=0)
+    assert report['grid_matches']
+    assert report['root_charge'] < 1e-4
+
+
+def test_folding_profile_matches_propka(container):
+    report = regression.folding_profile(container, repeat=0)
+    fixed = [entry for entry in report if entry['grid'] != 'adaptive']
+    adaptive = [entry for entry in report if entry['grid'] == 'adaptive']
+    assert len(adaptive) == 2
+    for entry in fixed:
+        assert entry['summary_matches']
+        assert entry['deviation'] < 1e-9
+    for entry in adaptive:
+        assert entry['deviation'] <= ADAPTIVE_TOLERANCE
+        assert entry['dG_opt_deviation'] <= ADAPTIVE_TOLERANCE
+        assert entry['pH_opt_excess'] <= ADAPTIVE_TOLERANCE
+        assert entry['range_deviation'] <= 2e-3
@@ -0,0 +1,46 @@
+# encoding: utf-8
+
+from __future__ import print_function, division
+import numpy as np
+import pytest
+from propkagui.container import with_coordinates
+from propkagui.engine import propka_run
+from propkagui.reuse import EnvironmentCache
+
+
+def _jittered(records, sigma, seed):
+    xyz = np.array([(r.x, r.y, r.z) for r in records])
+    return with_coordinates(records, xyz + np.random.RandomState(seed).normal(0, sigma, xyz.shape))
+
+
+def _run(records, cache):
+    results = propka_run(records, ['-q'], reuse=cache)
+    return results['reuse'], results['residues_pka']
+
+
+def test_identical_frames_reuse_everything(records):
+    cache = EnvironmentCache(0.0)
+    first, expected = _run(records, cache)
+    second, computed = _run(records, cache)
+    assert first['reused'] == 0
+    assert second['reused'] == second['groups'] > 0
+    assert computed == expected
+
+
+@pytest.mark.parametrize('sigma', [0.02, 0.05])
+def test_perturbed_frames_reuse_within_tolerance(records, sigma):
+    frame = _jittered(records, sigma, seed=1)
+    exact = propka_run(frame, ['-q'])['residues_pka']
+    cache = EnvironmentCache(0.5)
+    _run(records, cache)
+    stats, computed = _run(frame, cache)
+    assert stats['reused'] == stats['groups'] > 0
+    for residue, pka in exact.items():
+        assert computed[residue] == pytest.approx(pka, abs=0.5)
+
+
+def test_perturbed_frames_beyond_tolerance_are_recomputed(records):
+    cache = EnvironmentCache(0.0)
+    _run(records, cache)
+    stats, _ = _run(_jittered(records, 0.02, seed=2), cache)
+    assert stats['reused'] == 0